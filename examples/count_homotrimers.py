@@ -2,10 +2,16 @@
 # same bases
 
 from vaxpress.scoring import ScoringFunction
+from vaxpress.codons import encode_bases
+import numpy as np
 
 class HomoTrimerFitness(ScoringFunction):
 
-    single_submission = False
+    per_sequence = True
+
+    # The encoded sequences shared by all scoring functions are given in
+    # the "features" keyword argument, so the strings are not scanned again.
+    uses_features = True
 
     name = 'homotrimer'
     description = 'Homotrimer Count'
@@ -20,12 +26,19 @@ class HomoTrimerFitness(ScoringFunction):
     def __init__(self, weight, _length_cds):
         self.weight = -weight / _length_cds
 
-    def score(self, seqs):
-        counts = []
-        scores = []
-        for seq in seqs:
-            hcount = (seq.count('AAA') + seq.count('CCC') +
-                      seq.count('GGG') + seq.count('TTT'))
-            counts.append(hcount)
-            scores.append(hcount * self.weight)
+    # "features.bases" has a row of base codes (A=0, C=1, G=2, U=3) for each
+    # sequence. "features" is None when the lengths of the sequences differ.
+    def score(self, seqs, features=None):
+        if features is not None:
+            counts = self.count_homotrimers(features.bases)
+        else:
+            counts = np.array([self.count_homotrimers(encode_bases([seq]))[0]
+                               for seq in seqs])
+        scores = counts * self.weight
         return {'homotrimer': scores}, {'homotrimer': counts}
+
+    @staticmethod
+    def count_homotrimers(bases):
+        # Positions starting three of the same bases in a row
+        same = bases[:, 1:] == bases[:, :-1]
+        return (same[:, 1:] & same[:, :-1]).sum(axis=1)
@@ -5,11 +5,12 @@ from vaxpress.scoring import ScoringFunction
 
 class RestrictionSiteFitness(ScoringFunction):
 
-    # True: The scoring function is called with each sequence individually.
-    #       This is useful if the scoring function is computationally expensive.
-    # False: The scoring function is called with all sequences at once.
-    #        This is useful if the scoring function is fast or memory-intensive.
-    single_submission = False
+    # True: The score of each sequence depends only on the sequence itself.
+    #       The scoring function may be called with chunks of the sequences
+    #       in parallel, which helps if the scoring function is expensive.
+    # False: The scoring function is always called with all sequences at once.
+    #        Use this if the score of a sequence depends on the others.
+    per_sequence = True
 
     # Prefix in command line arguments, e.g. "--resite-weight"
     name = 'resite'
@@ -46,9 +47,8 @@ class RestrictionSiteFitness(ScoringFunction):
         if set(self.restriction_site) - set('ACGU'):
             raise ValueError('restriction site contains invalid characters')
 
-    # This function is called for every iteration. "seqs" is a list of strings
-    # if single_submission is False, or a single string if single_submission is
-    # True.
+    # This function is called for every iteration. "seqs" is a list of strings,
+    # which is a part of the population if per_sequence is True.
     def score(self, seqs):
         has_site = [] # 0s or 1s indicating existence of site for each sequence.
         scores = [] # fitness values for each sequences. Higher is better.
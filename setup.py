@@ -51,8 +51,9 @@ setup(
         'Programming Language :: Python :: 3 :: Only',
         'Topic :: Scientific/Engineering :: Bio-Informatics',
     ],
-    packages=['vaxpress', 'vaxpress.scoring', 'vaxpress.data'],
-    package_data={'vaxpress': ['report_template/*']},
+    packages=['vaxpress', 'vaxpress.scoring', 'vaxpress.folding_engines',
+              'vaxpress.data'],
+    package_data={'vaxpress': ['report_template/*', 'data/*.json']},
     data_files=[('share/vaxpress/examples',
         ['examples/count_homotrimers.py', 'examples/restriction_site.py',
          'examples/adenosine_in_stems.py'])],
@@ -72,7 +73,6 @@ setup(
         'tabulate >= 0.9',
         'Jinja2 >= 3.1',
         'plotly >= 5.0',
-        'pylru >= 1.2',
     ],
     extras_require={
         'nonfree': ['linearfold-unofficial'],
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# Compares the GC window penalty computed for each sequence with a loop over
+# the windows, as in the earlier versions, with the prefix sum version that
+# scores the whole population at once. Both are checked to give identical
+# results.
+#
+import argparse
+import numpy as np
+import time
+from vaxpress.scoring.gc_ratio import compute_gc_penalties
+
+def compute_gc_penalty_reference(seq, winsize, stride):
+    chars = np.frombuffer(seq.encode(), dtype=np.uint8)
+    isgc = ((chars == ord('G')) + (chars == ord('C')))
+    gc = []
+    for i in range(0, len(chars) - winsize + 1, stride):
+        gc.append(np.mean(isgc[i:i+winsize]))
+    gc = np.array(gc)
+    return -(10 ** np.log2(np.abs(gc - 0.5) + 0.1)).sum()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[1000, 4000, 10000])
+    parser.add_argument('--population', type=int, default=100)
+    parser.add_argument('--window-size', type=int, default=50)
+    parser.add_argument('--stride', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print('length\treference_ms\tbatch_ms\tspeedup')
+    for length in args.lengths:
+        # Random GC content for each sequence to cover the penalty range
+        seqs = []
+        for gc in rng.uniform(0.2, 0.8, args.population):
+            probs = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+            seqs.append(''.join(rng.choice(list('ACGU'), length, p=probs)))
+
+        start = time.perf_counter()
+        ref = [compute_gc_penalty_reference(seq, args.window_size,
+                                            args.stride) for seq in seqs]
+        ref_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = compute_gc_penalties(seqs, args.window_size, args.stride)
+        batch_time = time.perf_counter() - start
+
+        assert batch.tolist() == ref, f'results differ for length {length}'
+        print(f'{length}\t{ref_time * 1000:.2f}\t{batch_time * 1000:.2f}\t'
+              f'{ref_time / batch_time:.1f}x')
+
+if __name__ == '__main__':
+    main()
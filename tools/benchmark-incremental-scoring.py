@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Compares the per-child cost of scoring a population of mutants from
+# scratch with score() on the shared features and from the contributions of
+# their parents with score_edits() for the codon-local scoring functions.
+# Both paths score the whole population at once, as in the evaluator. The
+# scores are checked to agree up to the floating point rounding.
+#
+import argparse
+import numpy as np
+import time
+from vaxpress.mutant_generator import MutantGenerator
+from vaxpress.features import SequenceFeatures
+from vaxpress.codons import CodonEdits, encode_population
+from vaxpress.scoring.cai import CodonAdaptationIndexFitness
+from vaxpress.scoring.bicodon import BicodonAdaptationIndexFitness
+from vaxpress.scoring.ucount import UridineCountFitness
+from vaxpress.scoring.gc_ratio import GCRatioFitness
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+def create_scorers(mutantgen, length):
+    return [
+        CodonAdaptationIndexFitness(1.0, length, 'Homo sapiens', mutantgen),
+        BicodonAdaptationIndexFitness(1.0, length, 'Homo sapiens'),
+        UridineCountFitness(3.0, length),
+        GCRatioFitness(3.0, 50, 5, length),
+    ]
+
+def make_children(mutantgen, parent, count, n_edits, rng):
+    children = []
+    for _ in range(count):
+        positions = rng.choice(len(parent), n_edits, replace=False)
+        edits = []
+        for pos in sorted(positions.tolist()):
+            alternatives = mutantgen.synonymous_codons[parent[pos]]
+            if alternatives:
+                edits.append((pos, alternatives[rng.integers(len(alternatives))]))
+        codons = parent[:]
+        for pos, codon in edits:
+            codons[pos] = codon
+        children.append((''.join(codons), edits))
+    return children
+
+def benchmark_full(scorer, seqs, features, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = scorer.score(seqs, features=features)
+        elapsed.append(time.perf_counter() - start)
+    return results, min(elapsed) / len(seqs)
+
+def find_edits(parent, features, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        edits = CodonEdits(features.codons, encode_population([parent]),
+                           np.zeros(len(features), dtype=np.int64))
+        elapsed.append(time.perf_counter() - start)
+    return edits, min(elapsed) / len(features)
+
+def benchmark_edits(scorer, edits, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        contribs = scorer.prepare_edits(edits.parent_codons)
+        results = scorer.score_edits(contribs, edits)
+        elapsed.append(time.perf_counter() - start)
+    return results, min(elapsed) / len(edits)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[1000, 4000, 10000])
+    parser.add_argument('--children', type=int, default=200)
+    parser.add_argument('--edits', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print('length\tscorer\tfull_us\tedits_us\tspeedup')
+    for length in args.lengths:
+        protein = ''.join(rng.choice(list(AMINO_ACIDS), length // 3))
+        mutantgen = MutantGenerator(protein, np.random.RandomState(args.seed),
+                                    is_protein=True)
+        mutantgen.randomize_initial_codons()
+        parent = mutantgen.initial_codons
+        children = make_children(mutantgen, parent, args.children,
+                                 args.edits, rng)
+
+        seqs = [seq for seq, _ in children]
+        features = SequenceFeatures.create(seqs, mutantgen.codon2aa)
+        # The features are read once as in the evaluator.
+        for name in ('codons', 'gc_mask', 'u_mask'):
+            getattr(features, name)
+        # The edits are found once for all scoring functions.
+        edits, find_time = find_edits(''.join(parent), features, args.repeats)
+        print(f'{length}\t(find edits)\t-\t{find_time * 1e6:.1f}\t-')
+        for scorer in create_scorers(mutantgen, len(parent) * 3):
+            (scores, metrics), full_time = benchmark_full(
+                scorer, seqs, features, args.repeats)
+            (escores, emetrics), edit_time = benchmark_edits(
+                scorer, edits, args.repeats)
+            for name, values in scores.items():
+                assert np.allclose(values, escores[name], rtol=1e-9), \
+                    f'{scorer.name} scores differ for length {length}'
+                assert np.allclose(metrics[name], emetrics[name], rtol=1e-9)
+            print(f'{length}\t{scorer.name}\t{full_time * 1e6:.1f}\t'
+                  f'{edit_time * 1e6:.1f}\t{full_time / edit_time:.1f}x')
+        features.remove()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Compares the pure Python structure analysis used by the earlier versions
+# with the pair table based StructureAnalysis on random secondary structures
+# of 1-10 kb. Both paths are checked to give identical results. The timings
+# cover the features used by the built-in scoring functions and the mutant
+# generator; the stem lists kept for the addons are only compared.
+#
+import argparse
+import numpy as np
+import time
+from vaxpress.structure import (
+    StructureAnalysis, find_stems, unfold_unstable_structure, find_loops)
+
+def random_structure(length, rng):
+    # Random nested structure made of stems of 1-12 pairs with loops between
+    symbols = ['.'] * length
+    stack = [(0, length)]
+    while stack:
+        begin, end = stack.pop()
+        pos = begin
+        while end - pos > 10:
+            pos += rng.integers(0, 5)
+            stemlen = min(rng.integers(1, 13), (end - pos - 3) // 2)
+            span = rng.integers(stemlen * 2 + 3, end - pos + 1)
+            if stemlen < 1 or span > end - pos:
+                break
+            for k in range(stemlen):
+                symbols[pos + k] = '('
+                symbols[pos + span - 1 - k] = ')'
+            stack.append((pos + stemlen, pos + span - stemlen))
+            pos += span
+    return ''.join(symbols)
+
+def analyze_reference(structure, threshold, width):
+    folding, stems = unfold_unstable_structure(structure, find_stems(structure))
+    loops = find_loops(folding)
+    return {
+        'folding': folding,
+        'loops': loops,
+        'loop_length': sum(length * count for length, count in loops.items()
+                           if length >= threshold),
+        'long_stems': sum(len(loc5) >= 27 for loc5, _ in stems),
+        'start_paired': width - folding[:width].count('.'),
+        'loop_codons': sorted(set(i // 3 for i, code in enumerate(folding)
+                                  if code == '.')),
+    }
+
+def analyze_vectorized(structure, threshold, width):
+    analysis = StructureAnalysis.from_structure(structure).without_lone_pairs()
+    return {
+        'folding': analysis.structure,
+        'loops': analysis.loops,
+        'loop_length': analysis.total_loop_length(threshold),
+        'long_stems': int((analysis.stem_lengths >= 27).sum()),
+        'start_paired': analysis.count_paired(0, width),
+        'loop_codons': analysis.unpaired_codons.tolist(),
+    }
+
+def benchmark(func, structures, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = [func(s, 2, 15) for s in structures]
+        elapsed.append(time.perf_counter() - start)
+    return results, min(elapsed) / len(structures)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[1000, 2000, 5000, 10000])
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print('length\treference_ms\tvectorized_ms\tspeedup')
+    for length in args.lengths:
+        structures = [random_structure(length, rng) for _ in range(args.count)]
+        ref, ref_time = benchmark(analyze_reference, structures, args.repeats)
+        vec, vec_time = benchmark(analyze_vectorized, structures, args.repeats)
+        assert ref == vec, f'results differ for length {length}'
+        for structure in structures:
+            analysis = StructureAnalysis.from_structure(structure)
+            assert analysis.stems == find_stems(structure)
+        print(f'{length}\t{ref_time * 1000:.3f}\t{vec_time * 1000:.3f}\t'
+              f'{ref_time / vec_time:.1f}x')
+
+if __name__ == '__main__':
+    main()
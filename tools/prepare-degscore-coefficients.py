@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Derives the coefficients of DegScore from the original implementation
+# (https://github.com/eternagame/DegScore) and writes them to the package
+# data, so that the installed package computes DegScore without network
+# access. The original files are taken from --upstream-dir or from the
+# VaxPress cache directory, where they are downloaded by the fallback at
+# run time, and downloaded otherwise. The coefficients are fitted
+# on random sequences and structures, and written only after the loop types
+# and the per-position scores agree with the original code for the real
+# sequences given with --check, folded with ViennaRNA as in VaxPress.
+#
+import argparse
+import importlib.util as imputil
+import numpy as np
+import tempfile
+import time
+import sys
+import os
+from urllib import request
+from Bio import SeqIO
+from vaxpress.degscore import BUNDLED_COEFFICIENTS, DegScoreModel
+from vaxpress.datacache import get_cachepath
+from vaxpress.codons import BASES, encode_bases
+from vaxpress.structure import LOOP_TYPES, make_pair_table, assign_loop_types
+from vaxpress.sequence_evaluator import FoldEvaluator
+from vaxpress.folding_engines.vienna import ViennaRNAEngine
+
+DEGSCORE_RAW_PREFIX = 'https://raw.githubusercontent.com/eternagame/DegScore/master/'
+UPSTREAM_FILES = ['assign_loop_type.py', 'DegScore.py']
+
+def load_upstream_module(directory: str):
+    # Loads the original DegScore implementation from the directory with
+    # its files.
+    for fn in UPSTREAM_FILES:
+        mod = os.path.splitext(fn)[0]
+        spec = imputil.spec_from_file_location(mod, os.path.join(directory, fn))
+        module = imputil.module_from_spec(spec)
+        sys.modules[mod] = module
+        module.print = lambda *args, **kwargs: None
+        spec.loader.exec_module(module)
+
+    return sys.modules['DegScore']
+
+def random_structure(length: int, rng: np.random.Generator) -> str:
+    # Random nested structure made of stems of 1-12 pairs with loops between
+    symbols = ['.'] * length
+    stack = [(0, length)]
+    while stack:
+        begin, end = stack.pop()
+        pos = begin
+        while end - pos > 10:
+            pos += rng.integers(0, 5)
+            stemlen = min(rng.integers(1, 13), (end - pos - 3) // 2)
+            span = rng.integers(stemlen * 2 + 3, end - pos + 1)
+            if stemlen < 1 or span > end - pos:
+                break
+            for k in range(stemlen):
+                symbols[pos + k] = '('
+                symbols[pos + span - 1 - k] = ')'
+            stack.append((pos + stemlen, pos + span - stemlen))
+            pos += span
+    return ''.join(symbols)
+
+def sample_upstream_scores(module, n_seqs: int, length: int,
+                           rng: np.random.Generator):
+    seqs, loop_types, scores = [], [], []
+    for _ in range(n_seqs):
+        seq = ''.join(rng.choice(list(BASES), length))
+        structure = random_structure(length, rng)
+        mdl = module.DegScore(seq, structure=structure)
+        by_position = np.asarray(mdl.degscore_by_position, dtype=np.float64)
+        if not np.isclose(mdl.degscore, by_position.sum()):
+            raise ValueError('DegScore is not the sum of the positions')
+
+        seqs.append(seq)
+        loop_types.append(assign_loop_types(make_pair_table(structure)))
+        scores.append(by_position)
+    return encode_bases(seqs), np.array(loop_types), np.array(scores)
+
+def design_matrix(bases: np.ndarray, loop_types: np.ndarray, window: int):
+    # One-hot encoded bases, loop types and padding for every offset in the
+    # window followed by a column for the intercept
+    n_seqs, length = bases.shape
+    bases, loop_types = bases.astype(np.intp), loop_types.astype(np.intp)
+    width = len(BASES) + len(LOOP_TYPES) + 1
+    columns = np.zeros((n_seqs, length, (window * 2 + 1) * width + 1))
+    columns[:, :, -1] = 1
+    rows = np.arange(length)
+    for offset in range(window * 2 + 1):
+        src = rows + offset - window
+        inside = (src >= 0) & (src < length)
+        base = offset * width
+        columns[:, ~inside, base + width - 1] = 1
+        for i in range(n_seqs):
+            columns[i, rows[inside], base + bases[i, src[inside]]] = 1
+            columns[i, rows[inside],
+                    base + len(BASES) + loop_types[i, src[inside]]] = 1
+    return columns.reshape(n_seqs * length, -1)
+
+def derive_model(module, window: int=12, n_seqs: int=60, length: int=300,
+                 seed: int=0, tolerance: float=1e-8) -> DegScoreModel:
+    # The coefficients are recovered from the scores of the original
+    # implementation for random sequences and structures. The model is
+    # then checked on another set to reproduce the original scores.
+    rng = np.random.default_rng(seed)
+    bases, loop_types, scores = sample_upstream_scores(
+        module, n_seqs, length, rng)
+    coefs = np.linalg.lstsq(design_matrix(bases, loop_types, window),
+                            scores.ravel(), rcond=None)[0]
+
+    width = len(BASES) + len(LOOP_TYPES) + 1
+    offsets = coefs[:-1].reshape(window * 2 + 1, width)
+    model = DegScoreModel(
+        window, float(coefs[-1]), offsets[:, :len(BASES)],
+        offsets[:, len(BASES):-1], offsets[:, -1],
+        source=DEGSCORE_RAW_PREFIX)
+
+    bases, loop_types, scores = sample_upstream_scores(
+        module, n_seqs // 4, length, rng)
+    error = np.abs(model.score_by_position(bases, loop_types) - scores).max()
+    if error > tolerance:
+        raise ValueError('DegScore could not be reproduced by a linear model '
+                         f'with the window of {window} (error: {error:.3g})')
+    return model
+
+def download_upstream_module(directory):
+    for filename in UPSTREAM_FILES:
+        url = DEGSCORE_RAW_PREFIX + filename
+        print(f'Downloading {url}')
+        request.urlretrieve(url, os.path.join(directory, filename))
+
+def read_sequences(paths):
+    seqs = []
+    for path in paths:
+        for record in SeqIO.parse(path, 'fasta'):
+            seqs.append(str(record.seq).upper().replace('T', 'U'))
+    return seqs
+
+def check_model(model, module, seqs):
+    # Compares the loop types and the scores with the original code for
+    # each sequence folded in the same way as in VaxPress
+    foldeval = FoldEvaluator(ViennaRNAEngine())
+    write_loop_assignments = sys.modules['assign_loop_type'].write_loop_assignments
+    max_error = upstream_time = derived_time = 0
+    for seq in seqs:
+        folding = foldeval(seq)
+        loop_types = folding.analysis.loop_types
+        derived_loops = ''.join(LOOP_TYPES[c] for c in loop_types)
+        if derived_loops != write_loop_assignments(folding.folding):
+            raise ValueError(f'Loop types differ for a sequence of {len(seq)} nt')
+
+        start = time.perf_counter()
+        upstream = module.DegScore(seq, structure=folding.folding)
+        upstream_time += time.perf_counter() - start
+        start = time.perf_counter()
+        derived = model.score_by_position(encode_bases([seq]),
+                                          loop_types[None, :])[0]
+        derived_time += time.perf_counter() - start
+
+        max_error = max(max_error, np.abs(
+            derived - np.asarray(upstream.degscore_by_position)).max())
+    return max_error, upstream_time, derived_time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--upstream-dir', default=None,
+                        help='directory containing the original DegScore files')
+    parser.add_argument('--check', nargs='+', required=True, metavar='FASTA',
+                        help='real mRNA or CDS sequences to check the model')
+    parser.add_argument('--output', default=BUNDLED_COEFFICIENTS)
+    parser.add_argument('--window', type=int, default=12)
+    parser.add_argument('--tolerance', type=float, default=1e-8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = args.upstream_dir
+        if directory is None and all(os.path.exists(get_cachepath(fn))
+                                     for fn in UPSTREAM_FILES):
+            directory = get_cachepath('.')
+        if directory is None:
+            directory = tmpdir
+            download_upstream_module(directory)
+        module = load_upstream_module(directory)
+
+    model = derive_model(module, window=args.window, seed=args.seed,
+                         tolerance=args.tolerance)
+
+    seqs = read_sequences(args.check)
+    error, upstream_time, derived_time = check_model(model, module, seqs)
+    print(f'{len(seqs)} sequences checked: original '
+          f'{upstream_time * 1000:.1f} ms, bundled {derived_time * 1000:.1f} '
+          f'ms, max. difference {error:.3g}')
+    if error > args.tolerance:
+        sys.exit('The derived model does not reproduce the original scores.')
+
+    model.save(args.output)
+    print(f'Coefficients written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -23,7 +23,7 @@
 # THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
-from . import scoring, config, __version__
+from . import scoring, folding_engines, config, __version__
 from .evolution_chamber import CDSEvolutionChamber, ExecutionOptions
 from .presets import load_preset
 from .reporting import ReportGenerator
@@ -107,7 +107,7 @@ def apply_preset(main_parser, preset, default_off):
     for argname, argval in preset.items() if preset else []:
         if argname in ignore_options:
             continue
-        elif argname != 'fitness':
+        elif argname not in ('fitness', 'folding'):
             optname = '--' + argname.replace('_', '-')
             fix_option(optmap[optname], argval)
             continue
@@ -163,6 +163,36 @@ def check_argument_validity(args):
         else:
             args.conservative_start = f'{cons_iter}:{cons_width}'
 
+    if not (0 < args.screening_fraction <= 1):
+        print('Invalid value for --screening-fraction. RATE must be '
+              'in (0, 1].', file=sys.stderr)
+        sys.exit(1)
+
+    if args.prefilter_margin is not None and args.prefilter_margin < 0:
+        print('Invalid value for --prefilter-margin. SCORE must be '
+              'a non-negative number.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.ranked_full_scan is not None and args.ranked_full_scan < 1:
+        print('Invalid value for --ranked-full-scan. N must be '
+              'a positive integer.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.ranked_full_scan_budget < 1:
+        print('Invalid value for --ranked-full-scan-budget. N must be '
+              'a positive integer.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.folding_window is not None and args.folding_window < 50:
+        print('Invalid value for --folding-window. NT must be '
+              'at least 50.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.incremental_folding is not None and args.incremental_folding < 0:
+        print('Invalid value for --incremental-folding. FLANK must be '
+              'a non-negative integer.', file=sys.stderr)
+        sys.exit(1)
+
     if args.boost_loop_mutations is not None:
         try:
             if args.boost_loop_mutations.count(':') == 1:
@@ -189,7 +219,7 @@ def check_argument_validity(args):
         else:
             args.boost_loop_mutations = f'{boost_weight}:{boost_start}'
 
-def parse_options(scoring_funcs, preset, default_off):
+def parse_options(scoring_funcs, folding_engines, preset, default_off):
     parser = argparse.ArgumentParser(
         prog='vaxpress',
         description='VaxPress: A Codon Optimizer for mRNA Vaccine Design')
@@ -220,10 +250,65 @@ def parse_options(scoring_funcs, preset, default_off):
                      help='number of processes to use (default: 4)')
     grp.add_argument('--seed', type=int, default=922, metavar='NUMBER',
                      help='random seed (default: 922)')
+    engine_names = sorted(folding_engines)
     grp.add_argument('--folding-engine', default='vienna', metavar='NAME',
-                     choices=['vienna', 'linearfold'],
-                     help='RNA folding engine: vienna or linearfold '
-                          '(default: vienna)')
+                     choices=engine_names,
+                     help='RNA folding engine: ' + ', '.join(engine_names) +
+                          ' (default: vienna)')
+    grp.add_argument('--folding-window', type=int, default=None, metavar='NT',
+                     help='fold sequences longer than NT in windows of NT '
+                          'overlapping by a half (default: off)')
+    grp.add_argument('--screening-engine', default=None, metavar='NAME',
+                     choices=engine_names,
+                     help='fast RNA folding engine to screen the sequences '
+                          'before folding with the main engine (default: off)')
+    grp.add_argument('--screening-fraction', type=float, default=0.2,
+                     metavar='RATE',
+                     help='fraction of the top sequences in screening to be '
+                          'folded with the main engine (default: 0.2)')
+    grp.add_argument('--prefilter-margin', type=float, default=None,
+                     metavar='SCORE',
+                     help='skip folding of the children whose fitness '
+                          'estimated with the structures of their parents is '
+                          'lower than that of the survivors by SCORE plus the '
+                          'largest estimation error seen (heuristic; '
+                          'default: off)')
+    grp.add_argument('--incremental-folding', type=int, default=None,
+                     metavar='FLANK',
+                     help='refold only the regions around the mutated bases '
+                          'extended by FLANK nt to both sides (default: off)')
+    grp.add_argument('--incremental-folding-max-span', type=float, default=0.5,
+                     metavar='FRACTION',
+                     help='fold the full sequence instead when the regions to '
+                          'refold exceed this fraction of the sequence '
+                          '(default: 0.5)')
+    grp.add_argument('--incremental-folding-check', type=float, default=0.05,
+                     metavar='RATE',
+                     help='fraction of incrementally folded sequences to be '
+                          'validated against full refolding (default: 0.05)')
+    grp.add_argument('--incremental-scoring', action='store_true',
+                     default=False,
+                     help='score the children with the codon-local scoring '
+                          'functions from the contributions of their parents '
+                          '(default: off)')
+    grp.add_argument('--folding-cache-size', type=int, default=512,
+                     metavar='MB',
+                     help='maximum memory size of the folding cache in the '
+                          'main process, used only when the shared folding '
+                          'cache is disabled (default: 512)')
+    grp.add_argument('--shared-folding-cache-size', type=int, default=256,
+                     metavar='MB',
+                     help='size of the folding cache shared by all worker '
+                          'processes; 0 to disable (default: 256)')
+    grp.add_argument('--folding-store-size', type=int, default=1024,
+                     metavar='MB',
+                     help='maximum size of the on-disk store of folding '
+                          'results shared across runs; 0 to disable '
+                          '(default: 1024)')
+    grp.add_argument('--evaluation-cache-size', type=int, default=10000,
+                     metavar='N',
+                     help='number of sequences to keep the evaluation results '
+                          'for reuse; 0 to disable (default: 10000)')
     grp.add_argument('--default-off', default=False, action='store_true',
                      help='turn all fitness functions off by default')
 
@@ -245,6 +330,19 @@ def parse_options(scoring_funcs, preset, default_off):
     grp.add_argument('--full-scan-interval', type=int, default=300, metavar='N',
                      help='number of iterations between full scans of single '
                           'mutations of unpaired bases (default: 300)')
+    grp.add_argument('--full-scan-chunk-size', type=int, default=5000,
+                     metavar='N',
+                     help='number of single mutants evaluated at a time in '
+                          'full scans (default: 5000)')
+    grp.add_argument('--ranked-full-scan', type=int, default=None,
+                     metavar='N',
+                     help='fold the single mutants in full scans in the order '
+                          'of their estimated fitness and stop after N of '
+                          'them improve on their parents (default: off)')
+    grp.add_argument('--ranked-full-scan-budget', type=int, default=1000,
+                     metavar='N',
+                     help='maximum number of single mutants to fold in a '
+                          'ranked full scan (default: 1000)')
     grp.add_argument('--boost-loop-mutations',
                      default=f'1.5:{BOOST_LOOP_MUTATIONS_DEFAULT_WIDTH}',
                      metavar='WEIGHT[:START]', type=str,
@@ -272,6 +370,11 @@ def parse_options(scoring_funcs, preset, default_off):
                      help='number of amino acids to omit from the N-terminus '
                           'when calling LinearDesign (default: 5)')
 
+    engine_argmaps = []
+    for name in engine_names:
+        argmap = folding_engines[name].add_argument_parser(parser)
+        engine_argmaps.append((name, argmap))
+
     argmaps = []
     for func in sorted(scoring_funcs.values(), key=lambda f: f.priority):
         argmap = func.add_argument_parser(parser)
@@ -286,10 +389,16 @@ def parse_options(scoring_funcs, preset, default_off):
         for optname, varname in argmap:
             opts[varname] = getattr(args, optname[2:].replace('-', '_'))
 
+    folding_opts = {}
+    for name, argmap in engine_argmaps:
+        opts = folding_opts[name] = {}
+        for optname, varname in argmap:
+            opts[varname] = getattr(args, optname[2:].replace('-', '_'))
+
     config.initialize_config_if_needed(args)
     check_argument_validity(args)
 
-    return args, scoring_opts
+    return args, scoring_opts, folding_opts
 
 def initialize_outputdir(outputdir, overwrite=False):
     if os.path.exists(outputdir):
@@ -306,8 +415,10 @@ def initialize_outputdir(outputdir, overwrite=False):
 def run_vaxpress():
     preset, addon_paths, default_off = preparse_config_preset_addons()
     scoring_funcs = scoring.discover_scoring_functions(addon_paths)
+    engines = folding_engines.discover_folding_engines(addon_paths)
 
-    args, scoring_options = parse_options(scoring_funcs, preset, default_off)
+    args, scoring_options, folding_options = parse_options(
+        scoring_funcs, engines, preset, default_off)
 
     initialize_outputdir(args.output, args.overwrite)
     initialize_logging(os.path.join(args.output, 'log.txt'), args.quiet)
@@ -334,6 +445,9 @@ def run_vaxpress():
         conservative_start=args.conservative_start,
         boost_loop_mutations=args.boost_loop_mutations,
         full_scan_interval=args.full_scan_interval,
+        full_scan_chunk_size=args.full_scan_chunk_size,
+        ranked_full_scan=args.ranked_full_scan,
+        ranked_full_scan_budget=args.ranked_full_scan_budget,
         species=SPECIES_ALIASES.get(args.species, args.species),
         codon_table=args.codon_table,
         quiet=args.quiet,
@@ -345,6 +459,19 @@ def run_vaxpress():
         lineardesign_lambda=args.lineardesign,
         lineardesign_omit_start=args.lineardesign_omit_start,
         folding_engine=args.folding_engine,
+        folding_window=args.folding_window,
+        folding_engine_options=folding_options,
+        screening_engine=args.screening_engine,
+        screening_fraction=args.screening_fraction,
+        prefilter_margin=args.prefilter_margin,
+        incremental_folding=args.incremental_folding,
+        incremental_folding_max_span=args.incremental_folding_max_span,
+        incremental_folding_check=args.incremental_folding_check,
+        incremental_scoring=args.incremental_scoring,
+        folding_cache_size=args.folding_cache_size,
+        folding_store_size=args.folding_store_size,
+        shared_folding_cache_size=args.shared_folding_cache_size,
+        evaluation_cache_size=args.evaluation_cache_size,
     )
 
     next_report = 0 # Generate the first report immediately.
@@ -384,6 +511,9 @@ def run_vaxpress():
         log.error('Output directory already exists. Use --overwrite '
                   'option to overwrite it.')
         return 1
+    except RuntimeError as exc: # a scoring function is unavailable
+        log.error(str(exc))
+        return 1
 
 def generate_report(status, args, metainfo, scoring_options, execution_options,
                     inputseq, outputseq, scoring_funcs):
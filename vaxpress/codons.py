@@ -0,0 +1,87 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from itertools import product
+import numpy as np
+
+# Codons are numbered as base-4 numbers with A=0, C=1, G=2 and U=3. The
+# index of a codon pair is then c1 * 64 + c2, which follows the order of
+# product('ACGU', repeat=6) used in the bicodon usage tables.
+BASES = 'ACGU'
+CODONS = [''.join(c) for c in product(BASES, repeat=3)]
+CODON_INDEX = {codon: i for i, codon in enumerate(CODONS)}
+
+base_codes = np.zeros(256, dtype=np.uint8)
+base_codes[np.frombuffer(BASES.encode(), dtype=np.uint8)] = np.arange(4)
+codon_bytes = np.frombuffer(''.join(CODONS).encode(),
+                            dtype=np.uint8).reshape(64, 3)
+
+def encode_bases(seqs: list[str]) -> np.ndarray:
+    chars = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+    return base_codes[chars].reshape(len(seqs), -1)
+
+def bases_to_codons(bases: np.ndarray) -> np.ndarray:
+    return bases[:, 0::3] * 16 + bases[:, 1::3] * 4 + bases[:, 2::3]
+
+def encode_population(seqs: list[str]) -> np.ndarray:
+    return bases_to_codons(encode_bases(seqs))
+
+def encode_codons(seq: str) -> np.ndarray:
+    return encode_population([seq])[0]
+
+def decode_population(population: np.ndarray) -> list[str]:
+    if len(population) == 0:
+        return []
+    seqs = codon_bytes[population].tobytes().decode()
+    width = len(seqs) // len(population)
+    return [seqs[i:i+width] for i in range(0, len(seqs), width)]
+
+def decode_codons(codons: np.ndarray) -> str:
+    return codon_bytes[codons].tobytes().decode()
+
+def codon_pairs(codons: np.ndarray) -> np.ndarray:
+    codons = codons.astype(np.int64)
+    return codons[..., :-1] * 64 + codons[..., 1:]
+
+class CodonEdits:
+
+    # Codon changes of a batch of children from their parents, found at once
+    # for the whole batch. codons and parent_codons have a row for each
+    # child and each parent, and parents gives the parent row of each child.
+    # For each changed codon, child, position, old and new hold the child
+    # row, the codon position and the codon indices in the parent and the
+    # child.
+
+    def __init__(self, codons: np.ndarray, parent_codons: np.ndarray,
+                 parents: np.ndarray):
+        self.codons = codons
+        self.parent_codons = parent_codons
+        self.parents = parents
+        self.child, self.position = np.nonzero(codons != parent_codons[parents])
+        self.old = parent_codons[parents[self.child], self.position]
+        self.new = codons[self.child, self.position]
+
+    def __len__(self):
+        return len(self.codons)
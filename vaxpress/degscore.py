@@ -0,0 +1,121 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from .structure import LOOP_TYPES, StructureAnalysis
+from .codons import BASES
+import numpy as np
+import json
+import os
+
+COEFFICIENTS_FILE = 'degscore_coefficients.json'
+BUNDLED_COEFFICIENTS = os.path.join(os.path.dirname(__file__), 'data',
+                                    COEFFICIENTS_FILE)
+
+# Combined codes of a base and its loop type, and the code for the
+# positions beyond the ends of a sequence
+NUM_CONTEXTS = len(BASES) * len(LOOP_TYPES)
+PADDING = NUM_CONTEXTS
+
+
+class DegScoreModel:
+
+    # DegScore is a linear model of the bases and the loop types in a window
+    # around each position. The coefficients of the two are summed into a
+    # table for every offset in the window, so scoring a whole population
+    # takes one lookup per offset.
+
+    def __init__(self, window: int, intercept: float,
+                 nucleotide: np.ndarray, loop_type: np.ndarray,
+                 padding: np.ndarray, source: str=''):
+        self.window = window
+        self.intercept = intercept
+        self.nucleotide = np.asarray(nucleotide, dtype=np.float64)
+        self.loop_type = np.asarray(loop_type, dtype=np.float64)
+        self.padding = np.asarray(padding, dtype=np.float64)
+        self.source = source
+
+        self.table = np.empty((window * 2 + 1, NUM_CONTEXTS + 1))
+        self.table[:, :NUM_CONTEXTS] = (
+            self.nucleotide[:, :, None] + self.loop_type[:, None, :]
+        ).reshape(-1, NUM_CONTEXTS)
+        self.table[:, PADDING] = self.padding
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            params = json.load(f)
+        if (params['nucleotide_order'] != BASES or
+                params['loop_type_order'] != LOOP_TYPES):
+            raise ValueError(f'Unsupported DegScore coefficients in {path}')
+        return cls(params['window'], params['intercept'],
+                   params['nucleotide'], params['loop_type'],
+                   params['padding'], params.get('source', ''))
+
+    def save(self, path: str):
+        params = {
+            'source': self.source,
+            'window': self.window,
+            'intercept': self.intercept,
+            'nucleotide_order': BASES,
+            'loop_type_order': LOOP_TYPES,
+            'nucleotide': self.nucleotide.tolist(),
+            'loop_type': self.loop_type.tolist(),
+            'padding': self.padding.tolist(),
+        }
+        with open(path, 'w') as f:
+            json.dump(params, f, indent=1)
+
+    def score_by_position(self, bases: np.ndarray,
+                          loop_types: np.ndarray) -> np.ndarray:
+        # Both arguments are (sequences, length) matrices of the base codes
+        # (A=0, C=1, G=2, U=3) and the indices into LOOP_TYPES.
+        n_seqs, length = bases.shape
+        window = self.window
+        contexts = np.full((n_seqs, length + window * 2), PADDING,
+                           dtype=np.intp)
+        contexts[:, window:window + length] = (
+            bases.astype(np.intp) * len(LOOP_TYPES) + loop_types)
+
+        scores = np.full((n_seqs, length), self.intercept)
+        for offset, table in enumerate(self.table):
+            scores += table[contexts[:, offset:offset + length]]
+        return scores
+
+    def score(self, bases: np.ndarray, loop_types: np.ndarray) -> np.ndarray:
+        # Average DegScore of each sequence
+        return self.score_by_position(bases, loop_types).sum(axis=1) / \
+            bases.shape[1]
+
+
+def load_model():
+    # Returns None when the coefficients are not installed.
+    if not os.path.exists(BUNDLED_COEFFICIENTS):
+        return None
+    return DegScoreModel.load(BUNDLED_COEFFICIENTS)
+
+def loop_types_of(folding) -> np.ndarray:
+    if isinstance(folding, str):
+        return StructureAnalysis.from_structure(folding).loop_types
+    return folding.analysis.loop_types
@@ -32,8 +32,9 @@ from tabulate import tabulate
 from typing import Iterator, Dict, Any
 from collections import namedtuple
 from concurrent import futures
-from itertools import cycle
+from itertools import islice
 from .mutant_generator import MutantGenerator, STOP
+from .codons import encode_population, decode_population, decode_codons
 from .sequence_evaluator import SequenceEvaluator
 from .presets import dump_to_preset
 from .log import hbar, hbar_double, log
@@ -49,7 +50,12 @@ ExecutionOptions = namedtuple('ExecutionOptions', [
     'boost_loop_mutations', 'full_scan_interval', 'species', 'codon_table',
     'protein', 'quiet', 'seq_description', 'print_top_mutants', 'addons',
     'lineardesign_dir', 'lineardesign_lambda', 'lineardesign_omit_start',
-    'folding_engine',
+    'folding_engine', 'incremental_folding', 'incremental_folding_max_span',
+    'incremental_folding_check', 'folding_cache_size', 'folding_store_size',
+    'shared_folding_cache_size', 'screening_engine', 'screening_fraction',
+    'prefilter_margin', 'folding_window', 'folding_engine_options',
+    'evaluation_cache_size', 'incremental_scoring', 'full_scan_chunk_size',
+    'ranked_full_scan', 'ranked_full_scan_budget',
 ])
 
 class CDSEvolutionChamber:
@@ -111,9 +117,13 @@ class CDSEvolutionChamber:
                 self.quiet)
         elif self.execopts.random_initialization or self.execopts.protein:
             self.mutantgen.randomize_initial_codons()
-        self.population = [self.mutantgen.initial_codons]
+        # The population is kept as a matrix of codon indices with a row
+        # for each sequence.
+        self.population = encode_population(
+            [''.join(self.mutantgen.initial_codons)])
         self.population_foldings = [None]
         self.population_sources = [None]
+        self.full_scan_children = None
         parent_no_length = int(np.log10(self.execopts.n_survivors)) + 1
         self.format_parent_no = lambda n, length=parent_no_length: (
             format(n, f'{length}d').replace(' ', '-')
@@ -123,7 +133,7 @@ class CDSEvolutionChamber:
         self.full_scan_interval = self.execopts.full_scan_interval
         self.in_final_full_scan = False
 
-        self.length_aa = len(self.population[0])
+        self.length_aa = self.population.shape[1]
         self.length_cds = len(self.cdsseq)
 
         if self.execopts.conservative_start is not None:
@@ -140,10 +150,12 @@ class CDSEvolutionChamber:
         self.penalty_metric_flags = self.seqeval.penalty_metric_flags # XXX
 
         self.initial_sequence_evaluation = (
-            self.seqeval.prepare_evaluation_data(''.join(self.population[0])))
+            self.seqeval.prepare_evaluation_data(
+                decode_codons(self.population[0])))
 
         self.best_scores = []
         self.elapsed_times = []
+        self.screening_stats = {'iterations': 0, 'changed': 0}
         self.checkpoint_file = open(self.checkpoint_path, 'w')
         self.checkpoint_header_written = False
 
@@ -186,9 +198,6 @@ class CDSEvolutionChamber:
                  f'  mut_rate: {self.mutation_rate:.5f} -- '
                  f'E(muts): {self.expected_total_mutations:.1f}')
 
-        nextgeneration = self.population[:]
-        sources = list(range(len(nextgeneration)))
-
         choices = None
         for begin, end, altchoices in self.alternative_mutation_fields:
             if begin <= iter_no0 < end:
@@ -197,37 +206,197 @@ class CDSEvolutionChamber:
 
         assert len(self.population) == len(self.population_foldings)
 
-        n_new_mutants = max(0, self.execopts.n_population - len(self.population))
-        for parent, parent_folding, parent_no, _ in zip(
-                    cycle(self.population), cycle(self.population_foldings),
-                    cycle(range(len(self.population))), range(n_new_mutants)):
-            child = self.mutantgen.generate_mutant(parent, self.mutation_rate,
-                                                   choices, parent_folding)
-            nextgeneration.append(child)
-            sources.append(parent_no)
-
-        self.population[:] = nextgeneration
+        # Children are drawn from the parents in turn.
+        n_parents = len(self.population)
+        n_new_mutants = max(0, self.execopts.n_population - n_parents)
+        parent_nos = np.arange(n_new_mutants) % n_parents
+        children = self.mutantgen.generate_mutants(
+            self.population, parent_nos, self.mutation_rate, choices,
+            self.population_foldings)
+        sources = list(range(n_parents)) + parent_nos.tolist()
+        self.append_children([children], sources)
+
+    def append_children(self, children: list, sources: list[int]) -> None:
+        # The children are appended to the parents in the population.
+        self.prepare_folding_hints(sources)
+        self.population = np.vstack([self.population] + children)
         self.population_sources[:] = sources
-        self.flatten_seqs = [''.join(p) for p in self.population]
+        self.flatten_seqs = decode_population(self.population)
+
+    def prepare_folding_hints(self, sources: list[int]) -> None:
+        # Parent sequences and their structures are passed to the evaluator
+        # for the incremental refolding of the children.
+        n_parents = len(self.population)
+        parents = [
+            (seq, folding) if folding is not None else None
+            for seq, folding in zip(decode_population(self.population),
+                                    self.population_foldings)]
+        self.folding_hints = [
+            parents[src] if i >= n_parents else None
+            for i, src in enumerate(sources)]
 
     def prepare_full_scan(self, iter_no0: int) -> None:
         log.info(hbar)
         log.info(f'Iteration {iter_no0+1}/{self.execopts.n_iterations}  -- '
                  'FULL SCAN')
 
-        nextgeneration = self.population[:]
-        nextgen_sources = list(range(len(nextgeneration)))
-
+        # The children are generated lazily in evaluate_full_scan().
         traverse = self.mutantgen.traverse_all_single_mutations
-        for i, (seedseq, seedfold) in enumerate(
-                    zip(self.population, self.population_foldings)):
-            for child in traverse(seedseq, seedfold):
-                nextgeneration.append(child)
-                nextgen_sources.append(i)
+        self.full_scan_children = (
+            (i, child)
+            for i, (seedseq, seedfold) in enumerate(
+                zip(self.population, self.population_foldings))
+            for child in traverse(seedseq, seedfold))
+
+    def evaluate_full_scan(self, executor, n_parents):
+        # The single mutants are evaluated in chunks, keeping only the best
+        # child of each parent between the chunks. A scan that fits in a
+        # chunk is evaluated at once as a regular generation.
+        children, self.full_scan_children = self.full_scan_children, None
+        if self.execopts.ranked_full_scan is not None:
+            return self.evaluate_ranked_full_scan(executor, n_parents,
+                                                  children)
+
+        chunk_size = max(self.execopts.full_scan_chunk_size,
+                         self.execopts.n_population)
+        parents = self.population
+        best = {}
+        n_mutants = n_chunks = 0
+
+        while True:
+            chunk = list(islice(children, chunk_size))
+            if n_chunks > 0 and not chunk:
+                break
+            n_mutants += len(chunk)
+            n_chunks += 1
+
+            streaming = n_chunks > 1 or len(chunk) == chunk_size
+            by_parents = (streaming or len(parents) + len(chunk) >
+                          self.execopts.n_population)
+            results = self.evaluate_scan_chunk(executor, parents, chunk,
+                                               by_parents, best)
+            if results[0] is None or not streaming:
+                return by_parents, results
+            parent_results = self.slice_results(results, n_parents)
+
+        log.info(f' # Full scan: evaluated {n_mutants} single mutants in '
+                 f'{n_chunks} chunks')
+        return True, self.collect_scan_results(parents, parent_results, best)
+
+    def evaluate_ranked_full_scan(self, executor, n_parents, children):
+        # All single mutants are ranked by the fitness estimated with the
+        # structures of their parents. They are then folded in the order of
+        # the estimates until enough of them improve on their parents or the
+        # budget runs out. Only the mutated codons are kept for the ranking.
+        chunk_size = max(self.execopts.full_scan_chunk_size,
+                         self.execopts.n_population)
+        parents = self.population
+        hints = list(zip(decode_population(parents), self.population_foldings))
+        mutant_sources, positions, codons, estimates = [], [], [], []
+
+        while True:
+            chunk = list(islice(children, chunk_size))
+            if not chunk:
+                break
 
-        self.population[:] = nextgeneration
-        self.population_sources[:] = nextgen_sources
-        self.flatten_seqs = [''.join(p) for p in self.population]
+            srcs = np.array([src for src, _ in chunk])
+            rows = np.vstack([child for _, child in chunk])
+            totals = self.seqeval.estimate(decode_population(rows), executor,
+                                           [hints[src] for src in srcs])
+            if totals is None:
+                return True, (None, None, None, None)
+
+            pos = (rows != parents[srcs]).argmax(axis=1)
+            mutant_sources.extend(srcs.tolist())
+            positions.extend(pos.tolist())
+            codons.extend(rows[np.arange(len(rows)), pos].tolist())
+            estimates.extend(totals)
+
+        order = np.argsort(estimates, kind='stable')[::-1].tolist()
+        budget = min(self.execopts.ranked_full_scan_budget, len(order))
+        best = {}
+        n_evaluated = n_improving = 0
+
+        while True:
+            batch = order[n_evaluated:min(n_evaluated +
+                                          self.execopts.n_population, budget)]
+            chunk = []
+            for k in batch:
+                child = parents[mutant_sources[k]].copy()
+                child[positions[k]] = codons[k]
+                chunk.append((mutant_sources[k], child))
+
+            results = self.evaluate_scan_chunk(executor, parents, chunk, True,
+                                               best)
+            if results[0] is None:
+                return True, results
+            parent_results = self.slice_results(results, n_parents)
+
+            total_scores = results[0]
+            sources = np.array(self.population_sources[n_parents:], dtype=int)
+            n_improving += int(
+                (total_scores[n_parents:] > total_scores[sources]).sum())
+            n_evaluated += len(batch)
+            if (n_improving >= self.execopts.ranked_full_scan or
+                    n_evaluated >= budget):
+                break
+
+        log.info(f' # Ranked full scan: folded {n_evaluated} of {len(order)} '
+                 f'single mutants -- {n_improving} improving')
+        return True, self.collect_scan_results(parents, parent_results, best)
+
+    @staticmethod
+    def slice_results(results, n):
+        total_scores, scores, metrics, foldings = results
+        return (total_scores[:n],
+                {name: column[:n] for name, column in scores.items()},
+                {name: column[:n] for name, column in metrics.items()},
+                foldings[:n])
+
+    def evaluate_scan_chunk(self, executor, parents, chunk, by_parents, best):
+        # Evaluates the parents and a chunk of (parent no, child) pairs, and
+        # updates the best child of each parent in `best`.
+        n_parents = len(parents)
+        self.population = parents
+        self.append_children([child for _, child in chunk],
+                             list(range(n_parents)) +
+                             [src for src, _ in chunk])
+        results = self.evaluate_population(executor, n_parents, by_parents)
+        if results[0] is None:
+            return results
+
+        total_scores, scores, metrics, foldings = results
+        children = np.arange(n_parents, len(self.population))
+        sources = np.array(self.population_sources[n_parents:], dtype=int)
+        for k in self.find_best_in_groups(total_scores[children], sources):
+            src, i = sources[k], children[k]
+            if src not in best or total_scores[i] > best[src][0]:
+                best[src] = (
+                    total_scores[i], self.population[i].copy(),
+                    {name: column[i] for name, column in scores.items()},
+                    {name: column[i] for name, column in metrics.items()},
+                    foldings[i])
+        return results
+
+    def collect_scan_results(self, parents, parent_results, best):
+        # The parents and the best child of each parent form the population
+        # for the selection.
+        sources = sorted(best)
+        self.population = np.vstack([parents] +
+                                    [best[src][1] for src in sources])
+        self.population_sources[:] = list(range(len(parents))) + sources
+
+        self.flatten_seqs = decode_population(self.population)
+        total_scores, scores, metrics, foldings = parent_results
+        total_scores = np.concatenate(
+            [total_scores, [best[src][0] for src in sources]])
+        scores, metrics = (
+            {name: np.concatenate([column,
+                                   [best[src][k][name] for src in sources]])
+             for name, column in columns.items()}
+            for k, columns in ((2, scores), (3, metrics)))
+        foldings = list(foldings) + [best[src][4] for src in sources]
+        return total_scores, scores, metrics, foldings
 
     def run(self) -> Iterator[Dict[str, Any]]:
         self.show_configuration()
@@ -237,11 +406,12 @@ class CDSEvolutionChamber:
         last_winddown = 0
         error_code = 0
 
-        with futures.ProcessPoolExecutor(max_workers=self.n_processes) as executor:
+        with futures.ProcessPoolExecutor(max_workers=self.n_processes,
+                **self.seqeval.worker_initializer()) as executor:
 
             if self.execopts.n_iterations == 0:
                 # Only the initial sequence is evaluated
-                self.flatten_seqs = [''.join(self.population[0])]
+                self.flatten_seqs = decode_population(self.population[:1])
                 total_scores, scores, metrics, foldings = self.seqeval.evaluate(
                                                     self.flatten_seqs, executor)
                 if total_scores is None:
@@ -260,20 +430,31 @@ class CDSEvolutionChamber:
                 except StopIteration:
                     break
 
-                total_scores, scores, metrics, foldings = self.seqeval.evaluate(
-                                                    self.flatten_seqs, executor)
+                # Pick the best mutants in each parent to keep diversity in
+                # full scans
+                if self.full_scan_children is not None:
+                    by_parents, results = self.evaluate_full_scan(executor,
+                                                                  n_parents)
+                else:
+                    by_parents = (
+                        len(self.population) > self.execopts.n_population)
+                    results = self.evaluate_population(executor, n_parents,
+                                                       by_parents)
+
+                total_scores, scores, metrics, foldings = results
                 if total_scores is None:
                     # Termination due to errors from one or more scoring functions
                     error_code = 1
                     break
 
-                if len(self.population) > self.execopts.n_population:
-                    # Pick the best mutants in each parent to keep diversity
-                    ind_sorted = self.prioritized_sort_by_parents(total_scores)
-                else:
-                    ind_sorted = np.argsort(total_scores)[::-1]
+                ind_sorted = self.rank_population(total_scores, by_parents)
+                ind_sorted = self.refold_survivors(executor, ind_sorted,
+                                                   n_survivors, results)
+                if ind_sorted is None:
+                    error_code = 1
+                    break
                 survivor_indices = ind_sorted[:n_survivors]
-                survivors = [self.population[i] for i in survivor_indices]
+                survivors = self.population[survivor_indices]
                 survivor_foldings = [foldings[i] for i in survivor_indices]
                 self.best_scores.append(total_scores[ind_sorted[0]])
 
@@ -287,7 +468,7 @@ class CDSEvolutionChamber:
                 self.write_checkpoint(iter_no, survivor_indices, total_scores,
                                       scores, metrics, foldings)
 
-                self.population[:] = survivors
+                self.population = survivors
                 self.population_foldings[:] = survivor_foldings
 
                 log.info(' # Last best scores: ' +
@@ -311,19 +492,120 @@ class CDSEvolutionChamber:
 
         yield {'iter_no': -1, 'error': error_code, 'time': timelogs}
 
-    def prioritized_sort_by_parents(self, total_scores):
-        bestindices = []
+    def evaluate_population(self, executor, n_parents, by_parents):
+        # Children unlikely to survive are not folded when the prefilter is
+        # enabled. It is not used for full scans that pick survivors from
+        # each parent.
+        if self.execopts.prefilter_margin is not None and not by_parents:
+            prefilter = (n_parents, self.execopts.n_survivors,
+                         self.execopts.prefilter_margin)
+        else:
+            prefilter = None
+
+        if self.seqeval.screening_foldeval is None:
+            return self.seqeval.evaluate(self.flatten_seqs, executor,
+                                         self.folding_hints, prefilter=prefilter)
 
-        for src in np.unique(self.population_sources):
-            matches = np.where(self.population_sources == src)[0]
-            bestidx = max(matches, key=total_scores.__getitem__)
-            bestindices.append(bestidx)
+        # All sequences are screened with the fast folding engine first.
+        # Then, only the top fraction of them are folded again with the main
+        # engine and compete for survival.
+        total_scores, _, _, _ = self.seqeval.evaluate(
+            self.flatten_seqs, executor, screening=True)
+        if total_scores is None:
+            return None, None, None, None
 
-        bestindices.sort(key=total_scores.__getitem__, reverse=True)
+        n_survivors = self.execopts.n_survivors
+        ranked = self.rank_population(total_scores, by_parents)
+        n_refold = max(n_survivors, int(np.ceil(
+            len(self.population) * self.execopts.screening_fraction)))
+
+        # The parents are always kept as they have the exact foldings in the
+        # cache already. They also keep the front positions in the population.
+        top = np.argsort(total_scores)[::-1][:n_refold]
+        selected = sorted(set(range(n_parents)) | set(ranked[:n_survivors]) |
+                          set(top))
+        screened_survivors = set(ranked[:n_survivors])
+
+        self.population = self.population[selected]
+        self.population_sources[:] = [self.population_sources[i]
+                                      for i in selected]
+        self.flatten_seqs = [self.flatten_seqs[i] for i in selected]
+        self.folding_hints = [self.folding_hints[i] for i in selected]
+
+        results = self.seqeval.evaluate(self.flatten_seqs, executor,
+                                        self.folding_hints, prefilter=prefilter)
+        if results[0] is None:
+            return results
+
+        ranked = self.rank_population(results[0], by_parents)
+        exact_survivors = set(selected[i] for i in ranked[:n_survivors])
+
+        stats = self.screening_stats
+        stats['iterations'] += 1
+        stats['changed'] += exact_survivors != screened_survivors
+        log.info(f' # Screening: refolded {len(selected)} of '
+                 f'{len(total_scores)} sequences -- screening alone would have '
+                 f'changed the survivors in {stats["changed"]} of '
+                 f'{stats["iterations"]} iterations')
+
+        return results
+
+    def refold_survivors(self, executor, ind_sorted, n_survivors, results):
+        # Survivors with structures refolded locally or estimated from their
+        # parents are folded in full before they become parents or are
+        # written to the checkpoints, so that the errors of the
+        # approximations do not build up along the lineages. The results are
+        # updated in place and the survivors are ranked again.
+        total_scores, scores, metrics, foldings = results
+        survivor_indices = ind_sorted[:n_survivors]
+        approximate = [i for i in survivor_indices if foldings[i].approximate]
+        if not approximate:
+            return ind_sorted
+
+        exact = self.seqeval.evaluate(
+            [self.flatten_seqs[i] for i in approximate], executor)
+        if exact[0] is None:
+            return None
+
+        for k, i in enumerate(approximate):
+            total_scores[i] = exact[0][k]
+            for columns, exact_columns in ((scores, exact[1]),
+                                           (metrics, exact[2])):
+                for name, column in exact_columns.items():
+                    if name in columns:
+                        columns[name][i] = column[k]
+            foldings[i] = exact[3][k]
+        log.info(f' # Refolded {len(approximate)} survivors with approximate '
+                 'structures in full')
+
+        order = np.argsort(-total_scores[survivor_indices], kind='stable')
+        return np.concatenate([survivor_indices[order],
+                               ind_sorted[n_survivors:]])
+
+    def rank_population(self, total_scores, by_parents):
+        if by_parents:
+            return self.prioritized_sort_by_parents(total_scores)
+        else:
+            return np.argsort(total_scores)[::-1]
+
+    @staticmethod
+    def find_best_in_groups(total_scores, groups):
+        # Index of the best score in each group, the first one for ties,
+        # in the order of the groups
+        order = np.lexsort((-total_scores, groups))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = groups[order[1:]] != groups[order[:-1]]
+        return order[first]
+
+    def prioritized_sort_by_parents(self, total_scores):
+        total_scores = np.asarray(total_scores)
+        sources = np.array(self.population_sources, dtype=int)
+        bestindices = self.find_best_in_groups(total_scores, sources)
 
         # No need to put the rest back because the number of sources equals to
         # the number of survivors.
-        return bestindices
+        return bestindices[np.argsort(-total_scores[bestindices],
+                                      kind='stable')]
 
     def print_eval_results(self, total_scores, metrics, ind_sorted, n_parents) -> None:
         print_top = min(self.print_top_mutants, len(self.population))
@@ -331,7 +613,7 @@ class CDSEvolutionChamber:
         if len(rowstoshow) < 1:
             return
 
-        metrics_to_show = sorted(k for k in metrics[rowstoshow[0]].keys()
+        metrics_to_show = sorted(k for k in metrics.keys()
                                  if k not in self.penalty_metric_flags)
         header = ['flags', 'score'] + metrics_to_show
         tabdata = []
@@ -342,10 +624,11 @@ class CDSEvolutionChamber:
                 else self.format_parent_no(self.population_sources[i] + 1), # parent
                 'S ' if rank < self.execopts.n_survivors else '- '] # is survivor
             for name, flag in self.penalty_metric_flags.items():
-                flags.append(flag if metrics[i][name] != 0 in metrics[i] else '-')
+                flags.append(flag if name in metrics and metrics[name][i] != 0
+                             else '-')
 
             f_total = total_scores[i]
-            f_metrics = [metrics[i][name] for name in header[2:]]
+            f_metrics = [metrics[name][i] for name in header[2:]]
             tabdata.append([''.join(flags), f_total] +f_metrics)
 
         header_short = [h[:self.table_header_length] for h in header]
@@ -374,11 +657,11 @@ class CDSEvolutionChamber:
         fields = [('iter_no', iter_no), ('mutation_rate', self.mutation_rate),
                   ('fitness', total_scores[ind])]
         fields.extend([
-            ('metric:' + name, value)
-            for name, value in sorted(metrics[ind].items())])
+            ('metric:' + name, column[ind])
+            for name, column in sorted(metrics.items())])
         fields.extend([
-            ('score:' + name, value)
-            for name, value in sorted(scores[ind].items())])
+            ('score:' + name, column[ind])
+            for name, column in sorted(scores.items())])
         fields.append(('seq', self.flatten_seqs[ind]))
         fields.append(('structure', foldings[ind]['folding']))
 
@@ -392,7 +675,7 @@ class CDSEvolutionChamber:
 
     def save_results(self):
         # Save the best sequence
-        self.bestseq = ''.join(self.population[0])
+        self.bestseq = decode_codons(self.population[0])
         fastapath = os.path.join(self.outputdir, 'best-sequence.fasta')
         with open(fastapath, 'w') as f:
             print(f'>{self.seq_description}', file=f)
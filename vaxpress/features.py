@@ -0,0 +1,144 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from functools import cached_property
+from .codons import CODONS, encode_bases, bases_to_codons
+import numpy as np
+import tempfile
+import secrets
+import os
+
+# Memory maps of the feature files opened in this process, keyed by the path
+# and the generation token of the file, as a temporary path may be reused by
+# a later file.
+open_feature_files = {}
+
+def load_feature_file(path, generation, n_seqs, seqlength):
+    key = path, generation
+    if key not in open_feature_files:
+        # Only the file of the current generation is kept open. The maps
+        # of the earlier files are dropped, which closes them.
+        open_feature_files.clear()
+        open_feature_files[key] = np.memmap(
+            path, dtype=np.uint8, mode='r',
+            shape=(n_seqs, seqlength + seqlength // 3 * 2))
+    return open_feature_files[key]
+
+
+class SequenceFeatures:
+
+    # Encoded forms of the sequences in an evaluation shared by the scoring
+    # functions, with a row for each sequence: base codes (A=0, C=1, G=2,
+    # U=3), codon indices and the translated proteins in ASCII codes. The
+    # arrays are written once by the main process in a memory-mapped file.
+    # Only the path, the generation token and the selected rows are
+    # pickled, so the worker processes read the same file for all scoring
+    # functions.
+
+    def __init__(self, path: str, generation: str, n_seqs: int,
+                 seqlength: int, rows=None):
+        self.path = path
+        self.generation = generation
+        self.n_seqs = n_seqs
+        self.seqlength = seqlength
+        self.rows = rows
+
+    @classmethod
+    def create(cls, seqs: list[str], codon2aa: dict):
+        fd, path = tempfile.mkstemp(prefix='vaxpress-features-')
+        os.close(fd)
+
+        seqlength = len(seqs[0])
+        data = np.memmap(path, dtype=np.uint8, mode='w+',
+                         shape=(len(seqs), seqlength + seqlength // 3 * 2))
+        aa_codes = np.array([ord(codon2aa[c]) for c in CODONS],
+                            dtype=np.uint8)
+
+        features = cls(path, secrets.token_hex(8), len(seqs), seqlength)
+        bases, codons, protein = features.split_columns(data)
+        bases[:] = encode_bases(seqs)
+        codons[:] = bases_to_codons(bases)
+        protein[:] = aa_codes[codons]
+        data.flush()
+        del data
+        return features
+
+    def __getstate__(self):
+        return (self.path, self.generation, self.n_seqs, self.seqlength,
+                self.rows)
+
+    def __setstate__(self, state):
+        (self.path, self.generation, self.n_seqs, self.seqlength,
+         self.rows) = state
+
+    def __len__(self):
+        return self.n_seqs if self.rows is None else len(self.rows)
+
+    def subset(self, indices):
+        return SequenceFeatures(self.path, self.generation, self.n_seqs,
+                                self.seqlength, np.asarray(indices))
+
+    def remove(self):
+        open_feature_files.pop((self.path, self.generation), None)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def split_columns(self, data):
+        ncodons = self.seqlength // 3
+        return (data[:, :self.seqlength],
+                data[:, self.seqlength:self.seqlength + ncodons],
+                data[:, self.seqlength + ncodons:])
+
+    @cached_property
+    def data(self):
+        data = load_feature_file(self.path, self.generation, self.n_seqs,
+                                 self.seqlength)
+        return np.array(data if self.rows is None else data[self.rows])
+
+    @cached_property
+    def bases(self):
+        return np.ascontiguousarray(self.split_columns(self.data)[0])
+
+    @cached_property
+    def codons(self):
+        return np.ascontiguousarray(self.split_columns(self.data)[1])
+
+    @cached_property
+    def protein(self):
+        return np.ascontiguousarray(self.split_columns(self.data)[2])
+
+    @cached_property
+    def gc_mask(self):
+        return (self.bases == 1) | (self.bases == 2)
+
+    @cached_property
+    def u_mask(self):
+        return self.bases == 3
+
+    @cached_property
+    def proteins(self):
+        return [row.tobytes().decode() for row in self.protein]
@@ -0,0 +1,117 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import abc
+
+# Engine instances unpickled in each worker process, keyed by the class and
+# the options, so that the resources prepared by the engine are reused for
+# all the tasks sent to the worker.
+resident_engines = {}
+
+def restore_engine(engine_class, options):
+    key = (engine_class, tuple(sorted(options.items())))
+    if key not in resident_engines:
+        resident_engines[key] = engine_class(**options)
+    return resident_engines[key]
+
+class FoldingEngine(abc.ABC):
+
+    name = 'noname'
+    description = 'no description'
+
+    # Command line arguments
+    arguments = []
+
+    def __init__(self, **options):
+        self.options = options
+        self.initialize()
+
+    @classmethod
+    def add_argument_parser(cls, parser):
+        grp = parser.add_argument_group('Folding Engine - ' + cls.description)
+        argprefix = '--{name}-'.format(name=cls.name.replace('_', '-'))
+        argmap = []
+        for argname, argopts in cls.arguments:
+            grp.add_argument(argprefix + argname, **argopts)
+            argmap.append((argprefix + argname, argname.replace('-', '_')))
+        return argmap
+
+    def __reduce__(self):
+        return (restore_engine, (type(self), self.options))
+
+    def initialize(self):
+        pass
+
+    # Identifies the engine, its version and the options affecting the
+    # results in the form of "engine:version:parameters".
+    @property
+    @abc.abstractmethod
+    def signature(self) -> str:
+        raise NotImplementedError
+
+    # Returns the MFE structure in the dot-bracket notation and its energy.
+    @abc.abstractmethod
+    def fold(self, seq: str) -> tuple:
+        raise NotImplementedError
+
+    # Free energy of the sequence folded into the given structure. The
+    # default energy model of ViennaRNA is used unless overridden.
+    def evaluate_structure(self, seq: str, structure: str) -> float:
+        import RNA
+        fc = RNA.fold_compound(seq, RNA.md(), RNA.OPTION_EVAL_ONLY)
+        return fc.eval_structure(structure)
+
+def discover_folding_engines(addon_paths):
+    from . import __path__, __name__
+    import pkgutil
+    import importlib
+    import os
+    import sys
+
+    engines = {}
+
+    def scan_module(mod):
+        for objname in dir(mod):
+            obj = getattr(mod, objname)
+            if (obj is not FoldingEngine and type(obj) == abc.ABCMeta and
+                    issubclass(obj, FoldingEngine)):
+                engines[obj.name] = obj
+
+    for modinfo in pkgutil.iter_modules(__path__):
+        modname = f'{__name__}.{modinfo.name}'
+        mod = importlib.import_module(modname)
+        scan_module(mod)
+
+    # Addons may provide folding engines as well as scoring functions. See
+    # discover_scoring_functions for the details on loading them.
+    for filepath in addon_paths:
+        modname = os.path.splitext(os.path.basename(filepath))[0]
+        dirname = os.path.dirname(os.path.abspath(filepath))
+        if dirname not in sys.path:
+            sys.path.insert(0, dirname)
+        mod = importlib.import_module(modname)
+        scan_module(mod)
+
+    return engines
@@ -0,0 +1,52 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from . import FoldingEngine
+
+class LinearFoldEngine(FoldingEngine):
+
+    name = 'linearfold'
+    description = 'LinearFold'
+
+    # The Python binding of LinearFold does not take any options.
+    arguments = []
+
+    def initialize(self):
+        try:
+            import linearfold
+        except ImportError:
+            raise ImportError('LinearFold module is not available. Try "'
+                              'pip install linearfold-unofficial" to install.')
+        self._fold = linearfold.fold
+
+        from importlib.metadata import version
+        self.version = version('linearfold-unofficial')
+
+    @property
+    def signature(self) -> str:
+        return f'linearfold:{self.version}:default'
+
+    def fold(self, seq: str) -> tuple:
+        return self._fold(seq)
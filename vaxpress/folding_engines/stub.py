@@ -0,0 +1,82 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from . import FoldingEngine
+import time
+
+PAIR_ENERGIES = {
+    'GC': -3.0, 'CG': -3.0, 'AU': -2.0, 'UA': -2.0, 'GU': -1.0, 'UG': -1.0,
+}
+
+class StubFoldingEngine(FoldingEngine):
+
+    # Deterministic engine for benchmarking and testing the other parts of
+    # the pipeline. Bases are paired greedily with the nearest unpaired
+    # complementary base upstream, and each pair contributes a fixed energy.
+    # The folding time of the real engines can be emulated with the delay.
+
+    name = 'stub'
+    description = 'Stub Engine for Benchmarking'
+
+    min_hairpin_size = 3
+
+    arguments = [
+        ('delay', dict(
+            type=float, default=0.0, metavar='SEC',
+            help='time in seconds to spend per 1,000 nt for each folding '
+                 '(default: 0.0)')),
+    ]
+
+    @property
+    def signature(self) -> str:
+        return f'stub:1:delay={self.options.get("delay", 0.0)}'
+
+    def fold(self, seq: str) -> tuple:
+        delay = self.options.get('delay', 0.0)
+        if delay > 0:
+            time.sleep(delay * len(seq) / 1000)
+
+        structure = ['.'] * len(seq)
+        stack = []
+        for i, base in enumerate(seq):
+            if (stack and i - stack[-1] > self.min_hairpin_size and
+                    seq[stack[-1]] + base in PAIR_ENERGIES):
+                peer = stack.pop()
+                structure[peer], structure[i] = '(', ')'
+            else:
+                stack.append(i)
+
+        structure = ''.join(structure)
+        return structure, self.evaluate_structure(seq, structure)
+
+    def evaluate_structure(self, seq: str, structure: str) -> float:
+        energy = 0.0
+        stack = []
+        for i, symbol in enumerate(structure):
+            if symbol == '(':
+                stack.append(i)
+            elif symbol == ')':
+                energy += PAIR_ENERGIES.get(seq[stack.pop()] + seq[i], 0.0)
+        return energy
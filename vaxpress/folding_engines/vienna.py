@@ -0,0 +1,95 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from . import FoldingEngine
+import hashlib
+import os
+
+class ViennaRNAEngine(FoldingEngine):
+
+    name = 'vienna'
+    description = 'ViennaRNA'
+
+    arguments = [
+        ('temperature', dict(
+            type=float, default=37.0, metavar='CELSIUS',
+            help='folding temperature (default: 37.0)')),
+        ('dangles', dict(
+            type=int, default=2, choices=[0, 1, 2, 3], metavar='N',
+            help='treatment of dangling ends: 0, 1, 2 or 3 (default: 2)')),
+        ('no-lp', dict(
+            action='store_true', default=False,
+            help='disallow lonely pairs')),
+        ('no-gu', dict(
+            action='store_true', default=False,
+            help='disallow G-U pairs')),
+        ('param-file', dict(
+            type=str, default=None, metavar='FILE',
+            help='energy parameter file (default: Turner 2004)')),
+    ]
+
+    def initialize(self):
+        try:
+            import RNA
+        except ImportError:
+            raise ImportError('ViennaRNA module is not available. Try "'
+                              'pip install ViennaRNA" to install.')
+        self.RNA = RNA
+
+        # Energy parameters are loaded globally in ViennaRNA. The model
+        # details are kept to be reused for all sequences folded by this
+        # engine. (Replacing the sequence of a fold compound is not stable
+        # in the Python binding of ViennaRNA.)
+        param_file = self.options.get('param_file')
+        if param_file is not None:
+            if not RNA.params_load(param_file):
+                raise ValueError(f'Failed to load the energy parameters from '
+                                 f'{param_file}.')
+
+        md = self.md = RNA.md()
+        md.temperature = self.options.get('temperature', 37.0)
+        md.dangles = self.options.get('dangles', 2)
+        md.noLP = int(self.options.get('no_lp', False))
+        md.noGU = int(self.options.get('no_gu', False))
+
+    @property
+    def signature(self) -> str:
+        md = self.md
+        params = (f'T={md.temperature},dangles={md.dangles},'
+                  f'noLP={md.noLP},noGU={md.noGU}')
+
+        param_file = self.options.get('param_file')
+        if param_file is not None:
+            digest = hashlib.sha256(open(param_file, 'rb').read()).hexdigest()
+            params += f',params={os.path.basename(param_file)}:{digest[:16]}'
+
+        return f'vienna:{self.RNA.__version__}:{params}'
+
+    def fold(self, seq: str) -> tuple:
+        return self.RNA.fold_compound(seq, self.md).mfe()
+
+    def evaluate_structure(self, seq: str, structure: str) -> float:
+        fc = self.RNA.fold_compound(seq, self.md, self.RNA.OPTION_EVAL_ONLY)
+        return fc.eval_structure(structure)
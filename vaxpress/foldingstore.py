@@ -0,0 +1,378 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from .datacache import get_cachepath
+from .structure import FoldingRecord
+from .log import log
+from collections import OrderedDict
+import numpy as np
+import tempfile
+import hashlib
+import sqlite3
+import struct
+import mmap
+import zlib
+import time
+import os
+
+
+def digest_sequence(seq):
+    return hashlib.blake2b(seq.encode(), digest_size=16).digest()
+
+
+class FoldingCache:
+
+    # In-memory LRU cache of the folding records bounded by the total size
+    # in bytes. Sequences are keyed by their digests. Records are copied in
+    # and out so that the structure analyses built by the users of the
+    # records are not retained in the cache.
+
+    # Approximate per-entry overhead in bytes of the key and the linked list
+    entry_overhead = 160
+
+    def __init__(self, size_limit: int):
+        self.size_limit = size_limit
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, seq):
+        return digest_sequence(seq) in self.entries
+
+    def __getitem__(self, seq):
+        key = digest_sequence(seq)
+        self.entries.move_to_end(key)
+        return self.entries[key].copy()
+
+    def get(self, seq, default=None):
+        key = digest_sequence(seq)
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key].copy()
+
+    def __setitem__(self, seq, record):
+        key = digest_sequence(seq)
+        if key in self.entries:
+            self.size -= self.entries.pop(key).nbytes + self.entry_overhead
+
+        self.entries[key] = record = record.copy()
+        self.size += record.nbytes + self.entry_overhead
+
+        while self.size > self.size_limit and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes + self.entry_overhead
+
+
+class EvaluationCache:
+
+    # LRU cache of the evaluation results of the sequences, bounded by the
+    # number of sequences. An entry refers to a row of the columns of the
+    # total scores, the scores and the metrics of the evaluation that
+    # produced it, which are shared by all sequences of that evaluation,
+    # and keeps its own copy of the folding. All entries are dropped when
+    # the signature of the options affecting the results changes.
+
+    def __init__(self, size_limit: int):
+        self.size_limit = size_limit
+        self.signature = None
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def validate(self, signature):
+        if signature != self.signature:
+            self.entries.clear()
+            self.signature = signature
+
+    def get(self, seq, default=None):
+        key = digest_sequence(seq)
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        batch, row, folding = self.entries[key]
+        return batch, row, folding.copy()
+
+    def __setitem__(self, seq, result):
+        batch, row, folding = result
+        key = digest_sequence(seq)
+        self.entries[key] = batch, row, folding.copy()
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size_limit:
+            self.entries.popitem(last=False)
+
+
+class SharedFoldingCache:
+
+    # Open-addressing hash table of folding records in a memory-mapped file
+    # that is shared by the main process and the worker processes. All
+    # records have the same length as all sequences in a run have the same
+    # length. Slots are written without locks, and a checksum of each slot
+    # detects the slots being written by other processes. Those are simply
+    # treated as misses.
+
+    header = struct.Struct('<16sIBd')
+    probe_limit = 8
+    empty_key = bytes(16)
+
+    def __init__(self, path: str, seqlength: int, size_limit: int=None):
+        self.path = path
+        self.seqlength = seqlength
+        self.slot_size = self.header.size + (seqlength + 3) // 4
+        self.hits = self.misses = 0
+        self.total_hits = self.total_misses = 0
+
+        if size_limit is not None: # create a new cache file
+            self.n_slots = max(self.probe_limit, size_limit // self.slot_size)
+            with open(path, 'wb') as f:
+                f.truncate(self.n_slots * self.slot_size)
+        else:
+            self.n_slots = os.path.getsize(path) // self.slot_size
+
+        with open(path, 'r+b') as f:
+            self.mm = mmap.mmap(f.fileno(), self.n_slots * self.slot_size)
+
+    @classmethod
+    def create(cls, seqlength: int, size_limit: int):
+        fd, path = tempfile.mkstemp(prefix='vaxpress-foldings-')
+        os.close(fd)
+        return cls(path, seqlength, size_limit)
+
+    def attach_args(self):
+        return self.path, self.seqlength
+
+    def close(self, remove=False):
+        self.mm.close()
+        if remove:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def probe_slots(self, key):
+        home = int.from_bytes(key[:8], 'little')
+        for i in range(self.probe_limit):
+            yield (home + i) % self.n_slots * self.slot_size
+
+    def read_slot(self, offset):
+        data = self.mm[offset:offset + self.slot_size]
+        key, check, approximate, mfe = self.header.unpack_from(data)
+        if key == self.empty_key:
+            return key, None
+        elif zlib.crc32(data[self.header.size:],
+                      zlib.crc32(key + data[20:self.header.size])) != check:
+            return None, None
+        return key, (data, approximate, mfe)
+
+    def get(self, seq, count=False):
+        # Only the lookups with count=True are counted in the statistics,
+        # so that each sequence is counted once.
+        if len(seq) != self.seqlength:
+            return None
+
+        key = digest_sequence(seq)
+        for offset in self.probe_slots(key):
+            slotkey, contents = self.read_slot(offset)
+            if slotkey == key:
+                data, approximate, mfe = contents
+                packed = np.frombuffer(data, dtype=np.uint8,
+                                       offset=self.header.size)
+                self.hits += count
+                return FoldingRecord.from_packed(packed, self.seqlength, mfe,
+                                                 bool(approximate))
+            elif slotkey == self.empty_key:
+                break
+
+        self.misses += count
+        return None
+
+    def log_statistics(self):
+        # Lookups of the main process and those reported by the workers
+        self.total_hits += self.hits
+        self.total_misses += self.misses
+        log.info(f' # Shared folding cache: {self.hits} hits, {self.misses} '
+                 f'misses (total {self.total_hits} hits, '
+                 f'{self.total_misses} misses)')
+        self.hits = self.misses = 0
+
+    def put(self, seq, record):
+        if len(seq) != self.seqlength:
+            return
+
+        key = digest_sequence(seq)
+        target = None
+        for offset in self.probe_slots(key):
+            slotkey, contents = self.read_slot(offset)
+            if slotkey == key:
+                if record.approximate or not contents[1]:
+                    return # keep the existing record unless it's approximate
+                target = offset
+                break
+            elif slotkey == self.empty_key or slotkey is None:
+                target = offset
+                break
+
+        if target is None: # replace one of the occupied slots
+            target = list(self.probe_slots(key))[key[8] % self.probe_limit]
+
+        payload = struct.pack('<Bd', record.approximate, record.mfe)
+        packed = record.packed.tobytes()
+        check = zlib.crc32(packed, zlib.crc32(key + payload))
+        self.mm[target:target + self.slot_size] = (
+            self.header.pack(key, check, record.approximate, record.mfe) +
+            packed)
+
+
+class FoldingStore:
+
+    # The store is shared by all vaxpress processes of the user. SQLite with
+    # write-ahead logging handles the concurrent access from the processes.
+    filename = 'foldings.sqlite'
+    lookup_chunk_size = 500
+    eviction_ratio = 0.9
+
+    # Approximate per-entry overhead in bytes of the keys and the index
+    entry_overhead = 80
+
+    def __init__(self, signature: str, size_limit: int, path: str=None):
+        self.engine, self.version, self.params = signature.split(':', 2)
+        self.size_limit = size_limit
+        self.path = path if path is not None else get_cachepath(self.filename)
+        self.pending = []
+        self.hits = self.misses = 0
+        self.total_hits = self.total_misses = 0
+
+        self.initialize()
+
+    def initialize(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS foldings (
+                engine TEXT NOT NULL,
+                version TEXT NOT NULL,
+                params TEXT NOT NULL,
+                seqhash BLOB NOT NULL,
+                structure TEXT NOT NULL,
+                mfe REAL NOT NULL,
+                size INTEGER NOT NULL,
+                last_access INTEGER NOT NULL,
+                PRIMARY KEY (engine, version, params, seqhash)
+            )''')
+        self.db.execute('''
+            CREATE INDEX IF NOT EXISTS foldings_last_access
+            ON foldings (last_access)''')
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    @staticmethod
+    def hash_sequence(seq):
+        return hashlib.sha256(seq.encode()).digest()
+
+    def lookup(self, seqs):
+        found = {}
+        hashes = {self.hash_sequence(seq): seq for seq in seqs}
+        keys = list(hashes)
+
+        for i in range(0, len(keys), self.lookup_chunk_size):
+            chunk = keys[i:i+self.lookup_chunk_size]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.db.execute(f'''
+                SELECT seqhash, structure, mfe FROM foldings
+                WHERE engine = ? AND version = ? AND params = ? AND
+                      seqhash IN ({placeholders})''',
+                [self.engine, self.version, self.params] + chunk).fetchall()
+            for seqhash, structure, mfe in rows:
+                found[hashes[seqhash]] = structure, mfe
+
+        if found:
+            now = int(time.time())
+            self.execute_write('''
+                UPDATE foldings SET last_access = ?
+                WHERE engine = ? AND version = ? AND params = ? AND
+                      seqhash = ?''',
+                [(now, self.engine, self.version, self.params,
+                  self.hash_sequence(seq)) for seq in found])
+
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+
+        return found
+
+    def add(self, seq, structure, mfe):
+        self.pending.append((seq, structure, mfe))
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        now = int(time.time())
+        self.execute_write('''
+            INSERT OR REPLACE INTO foldings
+            (engine, version, params, seqhash, structure, mfe, size, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(self.engine, self.version, self.params, self.hash_sequence(seq),
+              structure, mfe, len(structure) + self.entry_overhead, now)
+             for seq, structure, mfe in self.pending])
+        self.pending.clear()
+
+        self.evict()
+
+    def evict(self):
+        total_size = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM foldings').fetchone()[0]
+        if total_size <= self.size_limit:
+            return
+
+        # Remove the least recently used entries of all engines and versions
+        target = total_size - int(self.size_limit * self.eviction_ratio)
+        self.execute_write('''
+            DELETE FROM foldings WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, size,
+                           SUM(size) OVER (ORDER BY last_access, rowid) AS cum
+                    FROM foldings)
+                WHERE cum - size < ?)''', [(target,)])
+
+    def execute_write(self, query, rows):
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany(query, rows)
+
+    def log_statistics(self):
+        self.total_hits += self.hits
+        self.total_misses += self.misses
+        log.info(f' # Folding store: {self.hits} hits, {self.misses} misses '
+                 f'(total {self.total_hits} hits, {self.total_misses} misses)')
+        self.hits = self.misses = 0
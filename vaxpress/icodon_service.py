@@ -0,0 +1,187 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# The iCodon predictions are made by a service process started once by the
+# main process. It reads requests from stdin, each made of a line with the
+# number of sequences followed by the sequences in separate lines, and
+# writes the predicted stability of each sequence in a line to stdout. Any
+# program following this protocol can be given in place of the built-in
+# service running iCodon in R through rpy2.
+#
+# The main process keeps a cache of the predictions keyed by the sequence
+# digests and relays the requests from the worker processes through a Unix
+# domain socket, so that the R setup is done once per run and sequences are
+# never predicted twice while they stay in the cache.
+
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+from .foldingstore import digest_sequence
+import subprocess as sp
+import threading
+import atexit
+import secrets
+import shlex
+import sys
+import os
+
+DEFAULT_COMMAND = [sys.executable, '-m', 'vaxpress.icodon_service']
+
+
+def iCodon_installed():
+    try:
+        import rpy2.robjects.packages as rpackages
+    except ModuleNotFoundError:
+        return False
+    return rpackages.isinstalled('iCodon')
+
+
+class iCodonService:
+
+    def __init__(self, species: str, command: str=None, cache_size: int=0):
+        command = (shlex.split(command) if command is not None
+                   else DEFAULT_COMMAND)
+        self.process = sp.Popen(command + [species], stdin=sp.PIPE,
+                                stdout=sp.PIPE, text=True)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+        self.authkey = secrets.token_bytes(16)
+        self.listener = Listener(family='AF_UNIX', authkey=self.authkey)
+        self.address = self.listener.address
+        threading.Thread(target=self.serve, daemon=True).start()
+        atexit.register(self.close)
+
+    def predict(self, seqs: list[str]) -> list[float]:
+        keys = [digest_sequence(seq) for seq in seqs]
+        with self.lock:
+            query = {}
+            for key, seq in zip(keys, seqs):
+                if key not in self.cache:
+                    query[key] = seq
+            if query:
+                # iCodon refuses the queries containing duplicates
+                self.cache.update(zip(query, self.request(list(query.values()))))
+
+            results = []
+            for key in keys:
+                self.cache.move_to_end(key)
+                results.append(self.cache[key])
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return results
+
+    def request(self, seqs: list[str]) -> list[float]:
+        try:
+            self.process.stdin.write(f'{len(seqs)}\n')
+            self.process.stdin.writelines(seq + '\n' for seq in seqs)
+            self.process.stdin.flush()
+            lines = [self.process.stdout.readline() for _ in seqs]
+        except BrokenPipeError:
+            lines = ['']
+        if not all(lines):
+            raise RuntimeError('The iCodon service terminated unexpectedly.')
+        return [float(line) for line in lines]
+
+    def serve(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError: # closed
+                break
+            threading.Thread(target=self.handle, args=(conn,),
+                             daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    seqs = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    conn.send(self.predict(seqs))
+                except Exception as exc:
+                    conn.send(exc)
+
+    def client_args(self) -> tuple:
+        return self.address, self.authkey
+
+    def close(self):
+        if self.process is None:
+            return
+        self.listener.close()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process = None
+
+
+class iCodonServiceClient:
+
+    # Connection to the service from a worker process, opened on the first
+    # prediction and kept open afterwards
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+
+    def predict(self, seqs: list[str]) -> list[float]:
+        if self.conn is None:
+            self.conn = Client(self.address, authkey=self.authkey)
+        self.conn.send(seqs)
+        results = self.conn.recv()
+        if isinstance(results, Exception):
+            raise results
+        return results
+
+
+def run_service(species: str):
+    os.environ['TZ'] = 'UTC' # dplyr requires this to run in singularity
+
+    import rpy2.robjects.packages as rpackages
+    rpackages.importr('iCodon')
+    rpackages.importr('stringr')
+
+    import rpy2.robjects as ro
+    ro.r['options'](warn=-1)
+    predfunc = ro.r['predict_stability'](species)
+
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        seqs = [sys.stdin.readline().strip() for _ in range(int(line))]
+        for pred in predfunc(seqs):
+            sys.stdout.write(f'{float(pred)!r}\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    run_service(sys.argv[1])
@@ -28,8 +28,10 @@ from collections import namedtuple
 import pandas as pd
 import numpy as np
 from . import lineardesign
+from .codons import CODON_INDEX
 
 STOP = '*'
+MAX_GUMBEL_KEYS = 1 << 22
 MutationChoice = namedtuple('MutationChoice', ['pos', 'altcodon'])
 
 class MutantGenerator:
@@ -81,6 +83,14 @@ class MutantGenerator:
                 self.synonymous_codons[c] = sorted(codons - set([c]))
                 self.codon2aa[c] = aa
 
+        # Same as synonymous_codons for the codon indices
+        max_alternatives = max(map(len, self.synonymous_codons.values()))
+        self.synonymous_indices = np.zeros((64, max_alternatives),
+                                           dtype=np.uint8)
+        for c, alternatives in self.synonymous_codons.items():
+            self.synonymous_indices[CODON_INDEX[c], :len(alternatives)] = [
+                CODON_INDEX[alt] for alt in alternatives]
+
     def backtranslate(self, proteinseq: str) -> str:
         return ''.join(next(iter(self.aa2codons[aa])) for aa in proteinseq)
 
@@ -121,60 +131,87 @@ class MutantGenerator:
         self.initial_codons[omitstart:] = [
             rseq[i*3:i*3+3] for i in range(len(prot_om))]
 
-    def calc_probabilities(self, choices: list[MutationChoice],
-                           folding: dict) -> np.ndarray:
-        minimum_position = self.boost_loop_mutations_start
-        loop_positions = set([i // 3 for i, code in enumerate(folding['folding'])
-                              if code == '.'])
-
-        weightmap = [1, self.boost_loop_mutations_weight]
-        probs = [weightmap[mut.pos in loop_positions and mut.pos >= minimum_position]
-                 for mut in choices]
-        return np.array(probs) / sum(probs)
-
-    def generate_mutant(self, codons: list[str], mutation_rate: float,
-                        choices: list[MutationChoice]=None,
-                        folding: dict=None) -> list[str]:
-        child = codons[:]
+    def calc_loop_weights(self, positions: np.ndarray,
+                          folding: dict) -> np.ndarray:
+        # Log weights of the choices at the given positions for boosting
+        # the mutations in the loops
+        if self.boost_loop_mutations_weight == 0 or folding is None:
+            return np.zeros(len(positions))
+
+        in_loop = np.zeros(len(self.initial_codons), dtype=bool)
+        in_loop[folding.analysis.unpaired_codons] = True
+        boosted = in_loop[positions] & (
+            positions >= self.boost_loop_mutations_start)
+        return np.where(boosted, np.log(self.boost_loop_mutations_weight), 0)
+
+    def generate_mutants(self, parents: np.ndarray, sources: np.ndarray,
+                         mutation_rate: float,
+                         choices: list[MutationChoice]=None,
+                         foldings: list=None) -> np.ndarray:
+        # Generates a child from parents[sources[i]] for each i. The
+        # mutations of a child are the top k choices by the log weights
+        # plus Gumbel noise, which samples k choices without replacement in
+        # proportion to the weights.
         if choices is None:
             choices = self.choices
+        positions = np.array([mut.pos for mut in choices])
+        altcodons = np.array([mut.altcodon for mut in choices])
+
+        # Loop boosting weights are prepared once for each parent.
+        if foldings is None:
+            foldings = [None] * len(parents)
+        weights = np.array([self.calc_loop_weights(positions, folding)
+                            for folding in foldings])
+
+        children = parents[sources]
+        n_mutations = self.rand.binomial(len(choices), mutation_rate,
+                                         len(children))
+        n_mutations = np.clip(n_mutations, 1, len(choices))
+
+        chunk_size = max(1, MAX_GUMBEL_KEYS // len(choices))
+        for begin in range(0, len(children), chunk_size):
+            end = min(begin + chunk_size, len(children))
+            keys = (self.rand.gumbel(size=(end - begin, len(choices))) +
+                    weights[sources[begin:end]])
+            counts = n_mutations[begin:end]
+            k = counts.max()
+            top = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(keys, top, axis=1), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+
+            # Applied one rank at a time, as a child may get two mutations
+            # at the same codon.
+            rows = np.arange(begin, end)
+            for j in range(k):
+                active = counts > j
+                sel = top[active, j]
+                cols, rowsel = positions[sel], rows[active]
+                children[rowsel, cols] = self.synonymous_indices[
+                    children[rowsel, cols], altcodons[sel]]
+
+        return children
+
+    def generate_mutant(self, codons: np.ndarray, mutation_rate: float,
+                        choices: list[MutationChoice]=None,
+                        folding: dict=None) -> np.ndarray:
+        return self.generate_mutants(codons[None], np.zeros(1, dtype=int),
+                                     mutation_rate, choices, [folding])[0]
 
-        # Draw number of mutations from binomial distribution
-        n_mutations = self.rand.binomial(len(choices), mutation_rate)
-        n_mutations = max(1, min(n_mutations, len(choices)))
-
-        prob_dist = (
-            self.calc_probabilities(choices, folding)
-            if self.boost_loop_mutations_weight != 0 and folding is not None
-            else None)
-
-        # Select mutations
-        mutation_choices = self.rand.choice(len(choices), n_mutations,
-                                            replace=False, p=prob_dist)
-
-        # Apply mutations
-        for i in mutation_choices:
-            mut = choices[i]
-            child[mut.pos] = self.synonymous_codons[child[mut.pos]][mut.altcodon]
-
-        return child
-
-    def traverse_all_single_mutations(self, parent: list[str],
+    def traverse_all_single_mutations(self, parent: np.ndarray,
                                       fold: list[str],
                                       choices: list[MutationChoice]=None):
         if choices is None:
             choices = self.choices
 
-        loop_positions = set([i // 3 for i, code in enumerate(fold['folding'])
-                              if code == '.'])
+        loop_positions = set(fold.analysis.unpaired_codons.tolist())
 
         for choice in self.choices:
             if choice.pos not in loop_positions:
                 continue
 
-            child = parent[:]
-            child[choice.pos] = self.synonymous_codons[child[choice.pos]][
-                                    choice.altcodon]
+            child = parent.copy()
+            child[choice.pos] = self.synonymous_indices[child[choice.pos],
+                                                        choice.altcodon]
             yield child
 
     def compute_expected_mutations(self, mutation_rate: float) -> float:
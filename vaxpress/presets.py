@@ -27,7 +27,7 @@ import json
 
 opts_to_remove = [
     'output', 'overwrite', 'quiet', 'seq_description', 'print_top_mutants',
-    'protein']
+    'protein', 'folding_engine_options']
 opt_aliases = {
     'n_iterations': 'iterations',
     'n_population': 'population',
@@ -48,6 +48,10 @@ def dump_to_preset(scoreopts, execopts):
             if not argname.startswith('_'):
                 mod[argname] = argval
 
+    data['folding'] = {
+        name: dict(opts)
+        for name, opts in execopts.folding_engine_options.items() if opts}
+
     return json.dumps(data, indent=2)
 
 def load_preset(data):
@@ -36,6 +36,26 @@ class ScoringFunction(abc.ABC):
     # If True, score() method is called with a list of folding predictions.
     uses_folding = False
 
+    # If True, the score of each sequence does not depend on the other
+    # sequences, so score() may be called for chunks of the population in
+    # parallel.
+    per_sequence = False
+
+    # If True, score() is also called with the keyword argument `features`,
+    # a SequenceFeatures with the base codes, codon indices, GC and U masks
+    # and translated proteins of the sequences computed once for all
+    # scoring functions. It is None when the lengths of the sequences
+    # differ.
+    uses_features = False
+
+    # If True, prepare_edits() and score_edits() are implemented to score
+    # the mutants from the contributions of their parents, for the whole
+    # population at once. prepare_edits(parent_codons) returns the
+    # contributions of the parents from a matrix of their codon indices,
+    # and score_edits(contributions, edits) returns the score and metric
+    # columns of the children from a CodonEdits.
+    supports_edits = False
+
     # If True, annotate_sequence() or evaluate_local() is called even when
     # the weight is zero.
     use_annotation_on_zero_weight = False
@@ -69,6 +89,12 @@ class ScoringFunction(abc.ABC):
     def score(self, seqs):
         raise NotImplementedError
 
+    def worker_options(self, opts):
+        # Options for building the instances in the worker processes. A
+        # scoring function holding a resource in the main process, such as
+        # a service process, adds the information to reach it.
+        return opts
+
 def discover_scoring_functions(addon_paths):
     from . import __path__, __name__
     import pkgutil
@@ -25,6 +25,7 @@
 
 from . import ScoringFunction
 from ..data import bicodon_usage_data
+from ..codons import encode_codons, encode_population, codon_pairs
 import numpy as np
 from itertools import product
 
@@ -33,6 +34,9 @@ class BicodonAdaptationIndexFitness(ScoringFunction):
     name = 'bicodon'
     description = 'Codon Adaptation Index of Codon-Pairs'
     priority = 21
+    per_sequence = True
+    uses_features = True
+    supports_edits = True
 
     requires = ['species']
     arguments = [
@@ -59,14 +63,53 @@ class BicodonAdaptationIndexFitness(ScoringFunction):
         self.bicodon_scores = dict(zip(pairs, bicodon_usage))
         assert len(self.bicodon_scores) == 4096
 
-    def score(self, seqs):
+        # Indexed by codon_pairs() of the codon indices
+        self.bicodon_score_table = bicodon_usage
+
+    def score(self, seqs, features=None):
         if len(seqs[0]) < 6:
             return [0.0] * len(seqs)
 
-        scores = self.bicodon_scores
-        bcai = np.array([
-            np.mean([scores[seq[i:i+6]] for i in range(0, len(seq) - 3, 3)])
-            for seq in seqs])
+        # The codon pair indices are taken from the codon indices of the
+        # whole population at once when the lengths are equal.
+        table = self.bicodon_score_table
+        if features is not None:
+            bcai = table[codon_pairs(features.codons)].mean(axis=1)
+        elif len(set(map(len, seqs))) == 1:
+            bcai = table[codon_pairs(encode_population(seqs))].mean(axis=1)
+        else:
+            bcai = np.array([table[codon_pairs(encode_codons(seq))].mean()
+                             for seq in seqs])
         bcai_score = bcai * self.weight
 
         return {'bicodon': bcai_score}, {'bicodon': bcai}
+
+    def prepare_edits(self, parent_codons):
+        return self.bicodon_score_table[codon_pairs(parent_codons)].sum(axis=1)
+
+    def score_edits(self, parent_totals, edits):
+        npairs = edits.codons.shape[1] - 1
+        if npairs < 1:
+            zeros = np.zeros(len(edits))
+            return {'bicodon': zeros}, {'bicodon': zeros}
+
+        # Each codon change affects the pairs with its two neighbors. The
+        # pairs shared by two changes are counted once.
+        pairs = np.concatenate([
+            edits.child * npairs + edits.position - 1,
+            edits.child * npairs + edits.position])
+        valid = np.concatenate([edits.position > 0,
+                                edits.position < npairs])
+        child, first = np.divmod(np.unique(pairs[valid]), npairs)
+
+        table = self.bicodon_score_table
+        parent = edits.parents[child]
+        pair_index = lambda c1, c2: c1.astype(np.int64) * 64 + c2
+        old = table[pair_index(edits.parent_codons[parent, first],
+                               edits.parent_codons[parent, first + 1])]
+        new = table[pair_index(edits.codons[child, first],
+                               edits.codons[child, first + 1])]
+        bcai = (parent_totals[edits.parents] + np.bincount(
+            child, new - old, minlength=len(edits))) / npairs
+
+        return {'bicodon': bcai * self.weight}, {'bicodon': bcai}
@@ -25,6 +25,7 @@
 
 from . import ScoringFunction
 from ..data import codon_usage_data
+from ..codons import CODONS, encode_codons, encode_population
 import numpy as np
 
 class CodonAdaptationIndexFitness(ScoringFunction):
@@ -32,6 +33,9 @@ class CodonAdaptationIndexFitness(ScoringFunction):
     name = 'cai'
     description = 'Codon Adaptation Index'
     priority = 20
+    per_sequence = True
+    uses_features = True
+    supports_edits = True
 
     use_annotation_on_zero_weight = True
 
@@ -61,18 +65,34 @@ class CodonAdaptationIndexFitness(ScoringFunction):
             scores.update(dict(zip(codons, np.log(freqs / freqs.max()))))
 
         self.codon_scores = scores
+        self.codon_score_table = np.array([scores[c] for c in CODONS])
 
-    def score(self, seqs):
-        scores = self.codon_scores
-        cai = np.array([
-            np.mean([scores[seq[i:i+3]] for i in range(0, len(seq), 3)])
-            for seq in seqs])
+    def score(self, seqs, features=None):
+        # The whole population is scored at once when the lengths are equal.
+        table = self.codon_score_table
+        if features is not None:
+            cai = table[features.codons].mean(axis=1)
+        elif len(set(map(len, seqs))) == 1:
+            cai = table[encode_population(seqs)].mean(axis=1)
+        else:
+            cai = np.array([table[encode_codons(seq)].mean() for seq in seqs])
         cai_score = cai * self.weight
 
         return {'cai': cai_score}, {'cai': cai}
 
+    def prepare_edits(self, parent_codons):
+        return self.codon_score_table[parent_codons].sum(axis=1)
+
+    def score_edits(self, parent_totals, edits):
+        table = self.codon_score_table
+        totals = parent_totals[edits.parents] + np.bincount(
+            edits.child, table[edits.new] - table[edits.old],
+            minlength=len(edits))
+        cai = totals / edits.codons.shape[1]
+
+        return {'cai': cai * self.weight}, {'cai': cai}
+
     def evaluate_local(self, seq):
-        scores = self.codon_scores
-        cai = np.array([scores[seq[i:i+3]] for i in range(0, len(seq), 3)])
+        cai = self.codon_score_table[encode_codons(seq)]
         centers = np.arange(0, len(seq), 3) + 1
         return {'cai': (centers, cai)}
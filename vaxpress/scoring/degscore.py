@@ -24,14 +24,20 @@
 #
 
 from . import ScoringFunction
+from ..codons import encode_bases
 from ..datacache import get_cachepath
+from ..degscore import load_model, loop_types_of
 from ..log import log
 import importlib.util as imputil
+import numpy as np
 import sys
 
 
 class LazyLoadingDegScoreProxy:
 
+    # The original implementation is used when the bundled coefficients
+    # are not installed.
+
     DEGSCORE_RAW_PREFIX = 'https://raw.githubusercontent.com/eternagame/DegScore/master/'
     download_addresses = {
         'DegScore.py': f'{DEGSCORE_RAW_PREFIX}DegScore.py',
@@ -53,7 +59,7 @@ class LazyLoadingDegScoreProxy:
             self.load_module()
 
         mdl = self.module.DegScore(seq, structure=fold)
-        return mdl.degscore_by_position
+        return np.asarray(mdl.degscore_by_position, dtype=np.float64)
 
     def load_module(self):
         try:
@@ -71,10 +77,8 @@ class LazyLoadingDegScoreProxy:
 
         self.module = sys.modules['DegScore']
 
-    # This method might need a locking mechanism in the future. Currently,
-    # it is not a problem because the first call is made only during the
-    # generation of the intermediate report for the first iteration in the main
-    # process.
+    # The files are downloaded by the main process when the scoring function
+    # is created, before the worker processes start.
     def download_module(self):
         import urllib.request
         import os
@@ -88,7 +92,53 @@ class LazyLoadingDegScoreProxy:
             log.info(f'==> Downloading a DegScore file from {url} to {cachepath}')
             urllib.request.urlretrieve(url, cachepath)
 
-call_degscore = LazyLoadingDegScoreProxy()
+
+def structure_of(folding):
+    return folding if isinstance(folding, str) else folding.folding
+
+
+class LazyLoadingDegScoreModel:
+
+    def __init__(self):
+        self.model = None
+        self.upstream = None
+
+    def get_model(self):
+        # Returns None when the original implementation is used instead.
+        if self.model is None and self.upstream is None:
+            self.model = load_model()
+            if self.model is None:
+                self.upstream = LazyLoadingDegScoreProxy()
+                self.upstream.load_module()
+        return self.model
+
+    def __call__(self, seq, fold):
+        return float(self.score_population([seq], [fold])[0])
+
+    def score_by_position(self, seq, fold):
+        model = self.get_model()
+        if model is None:
+            return self.upstream.score_by_position(seq, structure_of(fold))
+        return model.score_by_position(
+            encode_bases([seq]), loop_types_of(fold)[None, :])[0]
+
+    def score_population(self, seqs, foldings, bases=None):
+        model = self.get_model()
+        if model is None:
+            return np.array([self.upstream(seq, structure_of(fold))
+                             for seq, fold in zip(seqs, foldings)])
+
+        if len(set(map(len, seqs))) > 1:
+            return np.array([model.score(encode_bases([seq]),
+                                         loop_types_of(fold)[None, :])[0]
+                             for seq, fold in zip(seqs, foldings)])
+
+        if bases is None:
+            bases = encode_bases(seqs)
+        loop_types = np.array([loop_types_of(fold) for fold in foldings])
+        return model.score(bases, loop_types)
+
+call_degscore = LazyLoadingDegScoreModel()
 
 
 class DegScoreFitness(ScoringFunction):
@@ -97,6 +147,8 @@ class DegScoreFitness(ScoringFunction):
     description = 'DegScore (Eterna Predicted Degradation Rate)'
     priority = 15
     uses_folding = True
+    per_sequence = True
+    uses_features = True
 
     arguments = [
         ('weight',
@@ -106,18 +158,28 @@ class DegScoreFitness(ScoringFunction):
 
     def __init__(self, weight, _length_cds):
         self.weight = -weight
-
-    def score(self, seqs, foldings):
-        degscores = [call_degscore(seq, fold['folding'])
-                     for seq, fold in zip(seqs, foldings)]
+        # The original implementation is downloaded here if needed, so that
+        # a failure is reported before the optimization starts.
+        try:
+            call_degscore.get_model()
+        except OSError as exc:
+            raise RuntimeError(
+                'DegScore is unavailable: the bundled coefficients are not '
+                f'installed and the original code could not be loaded ({exc})'
+            ) from exc
+
+    def score(self, seqs, foldings, features=None):
+        bases = features.bases if features is not None else None
+        degscores = call_degscore.score_population(
+            seqs, foldings, bases).tolist()
         weighted_scores = [s * self.weight for s in degscores]
         return {'degscore': weighted_scores}, {'degscore': degscores}
 
     def annotate_sequence(self, seq, folding):
-        degscore = call_degscore(seq, folding['folding'])
+        degscore = call_degscore(seq, folding)
         return {'degscore': degscore}
 
     def evaluate_local(self, seq, folding):
-        degscore = call_degscore.score_by_position(seq, folding['folding'])
+        degscore = call_degscore.score_by_position(seq, folding)
         baseindex = list(range(len(seq)))
         return {'degscore': (baseindex, degscore)}
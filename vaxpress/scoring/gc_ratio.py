@@ -24,25 +24,52 @@
 #
 
 from . import ScoringFunction
+from ..codons import CODONS
 import numpy as np
 
+# GC flags of the three bases of each codon
+codon_gc_mask = np.array([[base in 'GC' for base in codon]
+                          for codon in CODONS])
+
+def gc_window_counts(seqs, winsize, stride, isgc=None):
+    # GC counts in the windows of sequences of the same length, taken from
+    # the prefix sums of a matrix with a row for each sequence
+    if isgc is None:
+        chars = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+        isgc = ((chars == ord('G')) |
+                (chars == ord('C'))).reshape(len(seqs), -1)
+    cumsum = np.zeros((isgc.shape[0], isgc.shape[1] + 1), dtype=np.int32)
+    np.cumsum(isgc, axis=1, out=cumsum[:, 1:])
+    starts = np.arange(0, isgc.shape[1] - winsize + 1, stride)
+    return cumsum[:, starts + winsize] - cumsum[:, starts]
+
 def gc_content_sliding_window(seq, winsize, stride):
-    chars = np.frombuffer(seq.encode(), dtype=np.uint8)
-    isgc = ((chars == ord('G')) + (chars == ord('C')))
-    gc = []
-    for i in range(0, len(chars) - winsize + 1, stride):
-        gc.append(np.mean(isgc[i:i+winsize]))
-    return np.array(gc)
+    return gc_window_counts([seq], winsize, stride)[0] / winsize
+
+def gc_window_penalties(gc):
+    return 10 ** np.log2(np.abs(gc - 0.5) + 0.1)
+
+def compute_gc_penalties(seqs, winsize, stride, isgc=None):
+    if isgc is None and len(set(map(len, seqs))) > 1:
+        return np.array([compute_gc_penalty(seq, winsize, stride)
+                         for seq in seqs])
+
+    # The rows are summed one by one as the summation along the axis of a
+    # matrix goes in a different order than that of a single array.
+    gc = gc_window_counts(seqs, winsize, stride, isgc) / winsize
+    return np.array([-row.sum() for row in gc_window_penalties(gc)])
 
 def compute_gc_penalty(seq, winsize, stride):
-    gc = gc_content_sliding_window(seq, winsize, stride)
-    return -(10 ** np.log2(np.abs(gc - 0.5) + 0.1)).sum()
+    return compute_gc_penalties([seq], winsize, stride)[0]
 
 class GCRatioFitness(ScoringFunction):
 
     name = 'gc'
     description = 'GC Ratio'
     priority = 50
+    per_sequence = True
+    uses_features = True
+    supports_edits = True
 
     use_annotation_on_zero_weight = True
 
@@ -66,12 +93,56 @@ class GCRatioFitness(ScoringFunction):
         self.window_size = window_size
         self.stride = stride
 
-    def score(self, seqs):
-        gc_penalties = [compute_gc_penalty(seq, self.window_size, self.stride)
-                        for seq in seqs]
-        scores = [s * self.weight for s in gc_penalties]
+    def score(self, seqs, features=None):
+        isgc = features.gc_mask if features is not None else None
+        gc_penalties = compute_gc_penalties(seqs, self.window_size,
+                                            self.stride, isgc)
+        scores = gc_penalties * self.weight
         return {'gc_penalty': scores}, {'gc_penalty': gc_penalties}
 
+    def prepare_edits(self, parent_codons):
+        counts = gc_window_counts(None, self.window_size, self.stride,
+                                  codon_gc_mask[parent_codons].reshape(
+                                      len(parent_codons), -1))
+        penalties = gc_window_penalties(counts / self.window_size)
+        return counts, penalties, penalties.sum(axis=1)
+
+    def score_edits(self, parent, edits):
+        counts, penalties, totals = parent
+        winsize, stride = self.window_size, self.stride
+
+        # Changes of the GC counts of the bases in the changed codons
+        delta = (codon_gc_mask[edits.new].astype(np.int64) -
+                 codon_gc_mask[edits.old]).ravel()
+        base = (edits.position[:, None] * 3 + np.arange(3)).ravel()
+        child = np.repeat(edits.child, 3)
+        changed = delta != 0
+        delta, base, child = delta[changed], base[changed], child[changed]
+
+        # Only the windows covering the changed bases are updated. Each base
+        # is expanded to the range of the windows covering it.
+        first = np.maximum(0, -(-(base - winsize + 1) // stride))
+        last = np.minimum(base // stride, counts.shape[1] - 1)
+        nwindows = np.maximum(last - first + 1, 0)
+        offsets = np.arange(nwindows.sum()) - np.repeat(
+            np.cumsum(nwindows) - nwindows, nwindows)
+        windows = np.repeat(first, nwindows) + offsets
+        keys, inverse = np.unique(
+            np.repeat(child, nwindows) * counts.shape[1] + windows,
+            return_inverse=True)
+        changes = np.bincount(inverse, np.repeat(delta, nwindows))
+        child, window = np.divmod(keys, counts.shape[1])
+
+        parent_rows = edits.parents[child]
+        newcounts = counts[parent_rows, window] + changes
+        updates = (gc_window_penalties(newcounts / winsize) -
+                   penalties[parent_rows, window])
+        gc_penalties = -(totals[edits.parents] + np.bincount(
+            child, updates, minlength=len(edits)))
+
+        return ({'gc_penalty': gc_penalties * self.weight},
+                {'gc_penalty': gc_penalties})
+
     def evaluate_local(self, seq):
         gc = gc_content_sliding_window(seq, self.window_size, self.stride)
         centers = (
@@ -24,6 +24,7 @@
 #
 
 from . import ScoringFunction
+from ..icodon_service import iCodon_installed, iCodonService, iCodonServiceClient
 
 ICODON_SPECIES_MAPPING = {
     'Homo sapiens': 'human',
@@ -31,64 +32,58 @@ ICODON_SPECIES_MAPPING = {
     'Danio rerio': 'zebrafish',
 }
 
-def check_iCodon_availability(kls):
-    try:
-        import rpy2.robjects.packages as rpackages
-    except ModuleNotFoundError:
-        return
+# iCodon is off by default unless it is installed. It can still be turned on
+# with a stand-in service given by --iCodon-command.
+DEFAULT_WEIGHT = 1.0 if iCodon_installed() else 0.0
 
-    try:
-        rpackages.importr('iCodon')
-    except rpackages.PackageNotInstalledError:
-        return
 
-    return kls
-
-@check_iCodon_availability
 class iCodonStabilityFitness(ScoringFunction):
 
-    iCodon_initialized = False
-    predfunc = None
-
     name = 'iCodon'
     description = 'iCodon'
     priority = 10
 
+    # The whole population is sent to the service in a single request.
+    per_sequence = False
+
     requires = ['species']
     arguments = [
         ('weight', dict(
-            type=float, default=1.0, metavar='WEIGHT',
-            help='scoring weight for iCodon predicted stability (default: 1.0)')),
+            type=float, default=DEFAULT_WEIGHT, metavar='WEIGHT',
+            help='scoring weight for iCodon predicted stability '
+                 f'(default: {DEFAULT_WEIGHT})')),
+        ('command', dict(
+            type=str, default=None, metavar='COMMAND',
+            help='command running the iCodon prediction service '
+                 '(default: built-in service using R)')),
+        ('cache-size', dict(
+            type=int, default=100000, metavar='N',
+            help='number of sequences with cached predictions '
+                 '(default: 100000)')),
     ]
 
-    def __init__(self, weight, _species, _length_cds):
+    def __init__(self, weight, command, cache_size, _species, _length_cds,
+                 _service=None):
         self.weight = weight
         if _species not in ICODON_SPECIES_MAPPING:
             raise ValueError(f"Unsupported species by iCodon: {_species}")
         self.species = ICODON_SPECIES_MAPPING[_species]
         self.length_cds = _length_cds
 
-    def score(self, seqs):
-        if not self.iCodon_initialized:
-            import os
-            os.environ['TZ'] = 'UTC' # dplyr requires this to run in singularity
-
-            import rpy2.robjects.packages as rpackages
-            rpackages.importr('iCodon')
-            rpackages.importr('stringr')
-
-            import rpy2.robjects as ro
-            ro.r['options'](warn=-1)
-            self.predfunc = ro.r['predict_stability'](self.species)
+        # The service is started by the instance in the main process and
+        # the instances in the workers connect to it.
+        if _service is not None:
+            self.service = iCodonServiceClient(*_service)
+        else:
+            if command is None and not iCodon_installed():
+                raise ValueError('iCodon is not installed. Install rpy2 and '
+                                 'iCodon or set --iCodon-command.')
+            self.service = iCodonService(self.species, command, cache_size)
 
-            self.iCodon_initialized = True
+    def worker_options(self, opts):
+        return dict(opts, _service=self.service.client_args())
 
-        # Remove duplicates since iCodon refuses prediction of sequence lists
-        # containing duplicates
-        query = list(set(seqs))
-        results = self.predfunc(query)
-        results = dict(zip(query, results))
-
-        pred = [float(results[s]) for s in seqs]
+    def score(self, seqs):
+        pred = self.service.predict(seqs)
         scores = [s * self.weight for s in pred]
         return {'pred_stability': scores}, {'pred_stability': pred}
@@ -31,6 +31,7 @@ class LongStemFitness(ScoringFunction):
     description = 'RNA Folding (Long Stems)'
     priority = 43
     uses_folding = True
+    per_sequence = True
 
     arguments = [
         ('weight', dict(metavar='WEIGHT',
@@ -55,14 +56,13 @@ class LongStemFitness(ScoringFunction):
         scores = []
 
         for fold in foldings:
-            stems = fold['stems']
-            longstems = sum(len(loc5) >= self.threshold for loc5, _ in stems)
+            stem_lengths = fold.analysis.stem_lengths
+            longstems = int((stem_lengths >= self.threshold).sum())
             metrics.append(longstems)
             scores.append(longstems * self.weight)
 
         return {'longstem': scores}, {'longstem': metrics}
 
     def annotate_sequence(self, seq, folding):
-        longstems = sum(len(loc5) >= self.threshold
-                        for loc5, _ in folding['stems'])
+        longstems = int((folding.analysis.stem_lengths >= self.threshold).sum())
         return {'longstems': longstems}
@@ -31,6 +31,7 @@ class LoopLengthFitness(ScoringFunction):
     description = 'RNA Folding (Loops)'
     priority = 41
     uses_folding = True
+    per_sequence = True
 
     arguments = [
         ('weight', dict(metavar='WEIGHT',
@@ -49,16 +50,12 @@ class LoopLengthFitness(ScoringFunction):
         loop_lengths = []
         scores = []
         for fold in foldings:
-            looplen = sum(length * count
-                          for length, count in fold['loops'].items()
-                          if length >= self.threshold)
+            looplen = fold.analysis.total_loop_length(self.threshold)
             loop_lengths.append(looplen)
             scores.append(looplen * self.weight)
 
         return {'loop': scores}, {'loop': loop_lengths}
 
     def annotate_sequence(self, seq, folding):
-        looplen = sum(length * count
-                      for length, count in folding['loops'].items()
-                      if length >= self.threshold)
+        looplen = folding.analysis.total_loop_length(self.threshold)
         return {'loop': looplen}
@@ -31,6 +31,7 @@ class MFEFitness(ScoringFunction):
     description = 'RNA Folding (MFE)'
     priority = 40
     uses_folding = True
+    per_sequence = True
 
     arguments = [
         ('weight', dict(
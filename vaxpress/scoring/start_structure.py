@@ -31,6 +31,7 @@ class StartCodonStructureFitness(ScoringFunction):
     description = 'RNA Folding (Structure near Start Codon)'
     priority = 42
     uses_folding = True
+    per_sequence = True
 
     arguments = [
         ('weight', dict(
@@ -55,15 +56,12 @@ class StartCodonStructureFitness(ScoringFunction):
         scores = []
 
         for fold in foldings:
-            start_structure = fold['folding'][:self.width]
-
-            start_folded = start_structure.count('(') + start_structure.count(')')
+            start_folded = fold.analysis.count_paired(0, self.width)
             metrics.append(start_folded)
             scores.append(start_folded * self.weight)
 
         return {'start_str': scores}, {'start_str': metrics}
 
     def annotate_sequence(self, seq, folding):
-        start_structure = folding['folding'][:self.width]
-        start_folded = start_structure.count('(') + start_structure.count(')')
+        start_folded = folding.analysis.count_paired(0, self.width)
         return {'start_str': start_folded}
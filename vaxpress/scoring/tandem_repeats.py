@@ -31,6 +31,7 @@ class TandemRepeatsFitness(ScoringFunction):
     name = 'repeats'
     description = 'Tandem Repeats'
     priority = 60
+    per_sequence = True
 
     arguments = [
         ('weight',
@@ -24,12 +24,19 @@
 #
 
 from . import ScoringFunction
+from ..codons import CODONS
+import numpy as np
+
+codon_ucounts = np.array([codon.count('U') for codon in CODONS])
 
 class UridineCountFitness(ScoringFunction):
 
     name = 'ucount'
     description = 'Uridines'
     priority = 30
+    per_sequence = True
+    uses_features = True
+    supports_edits = True
 
     arguments = [
         ('weight',
@@ -40,7 +47,21 @@ class UridineCountFitness(ScoringFunction):
     def __init__(self, weight, _length_cds):
         self.weight = -weight / _length_cds * 4
 
-    def score(self, seqs):
-        ucounts = [s.count('U') for s in seqs]
+    def score(self, seqs, features=None):
+        if features is not None:
+            ucounts = features.u_mask.sum(axis=1).tolist()
+        else:
+            ucounts = [s.count('U') for s in seqs]
+        scores = [s * self.weight for s in ucounts]
+        return {'ucount': scores}, {'ucount': ucounts}
+
+    def prepare_edits(self, parent_codons):
+        return codon_ucounts[parent_codons].sum(axis=1)
+
+    def score_edits(self, parent_ucounts, edits):
+        ucounts = parent_ucounts[edits.parents]
+        np.add.at(ucounts, edits.child,
+                  codon_ucounts[edits.new] - codon_ucounts[edits.old])
+        ucounts = ucounts.tolist()
         scores = [s * self.weight for s in ucounts]
         return {'ucount': scores}, {'ucount': ucounts}
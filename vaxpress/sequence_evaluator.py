@@ -24,93 +24,309 @@
 #
 
 import sys
-import re
-import pylru
+import json
+import time
+import zlib
+import hashlib
+import atexit
+import sqlite3
+import numpy as np
+from collections import OrderedDict
 from tqdm import tqdm
 from concurrent import futures
-from collections import Counter
+from .folding_engines import FoldingEngine, discover_folding_engines
+from .foldingstore import (
+    FoldingStore, FoldingCache, SharedFoldingCache, EvaluationCache)
+from .structure import (
+    FoldingRecord, StructureAnalysis, make_pair_table, pair_table_to_structure,
+    base_pair_distance, remove_noncanonical_pairs)
+from .features import SequenceFeatures
+from .codons import CodonEdits, encode_population
 from .log import hbar_stars, log
 
+# Folding cache shared with the main process, attached in each worker process
+worker_shared_cache = None
+
+# Scoring functions built once in each worker process
+worker_scoring_funcs = {}
+
+# Local folds of the parent regions in each process, so that the children of
+# a parent fold each region of the parent only once
+local_fold_cache = OrderedDict()
+LOCAL_FOLD_CACHE_SIZE = 4096
+
+
+def initialize_worker(shared_cache_args, scorefunc_specs, folding_engines):
+    global worker_shared_cache
+
+    if shared_cache_args is not None:
+        worker_shared_cache = SharedFoldingCache(*shared_cache_args)
+
+    for name, (cls, opts) in scorefunc_specs.items():
+        worker_scoring_funcs[name] = cls(**opts)
+
+    # The folding engines are already restored as the resident instances of
+    # this process while unpickling the arguments. Folding a short sequence
+    # loads the energy parameters before the first task arrives.
+    for engine in folding_engines:
+        engine.fold('GGGGAAACCCC')
+
+def run_scoring(name, *args, **kwargs):
+    return worker_scoring_funcs[name](*args, **kwargs)
+
+def fold_sequence(foldeval, seq, hint, validate, publish):
+    if worker_shared_cache is not None:
+        folding = worker_shared_cache.get(seq)
+        if folding is not None and (hint is not None or
+                                    not folding.approximate):
+            return folding, None
+
+    if hint is not None:
+        folding, stats = foldeval.fold_incremental(seq, *hint, validate)
+    else:
+        folding, stats = foldeval(seq), None
+
+    if worker_shared_cache is not None and publish:
+        worker_shared_cache.put(seq, folding)
+    return folding, stats
+
+def fold_batch(foldeval, tasks, publish=True):
+    try:
+        started = time.time()
+        results = [fold_sequence(foldeval, seq, hint, validate, publish)
+                   for seq, hint, validate in tasks]
+        return results, time.time() - started
+    except KeyboardInterrupt:
+        return None
+
+
+def update_columns(columns, updates, indices, size):
+    # Scores and metrics are kept in an array for each name with an entry
+    # for each sequence. Entries never set are NaN, or zero in the columns
+    # of integers.
+    indices = np.asarray(indices, dtype=np.intp)
+    for name, values in updates.items():
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = values.astype(np.float64)
+        column = columns.get(name)
+        if column is None:
+            column = columns[name] = (
+                np.zeros(size, dtype=values.dtype)
+                if values.dtype.kind in 'iub' else np.full(size, np.nan))
+        elif np.result_type(column, values) != column.dtype:
+            column = columns[name] = column.astype(
+                np.result_type(column, values))
+        column[indices] = values
+
+def sum_columns(columns, size):
+    totals = np.zeros(size)
+    for name in sorted(columns):
+        totals += columns[name]
+    return totals
+
+def estimate_batch(engine, tasks):
+    # The structure of the parent evaluated on the child gives an upper bound
+    # of the MFE of the child. Pairs that are not allowed in the child are
+    # opened to keep the structure valid.
+    try:
+        results = []
+        for seq, parent_folding in tasks:
+            structure = remove_noncanonical_pairs(seq, parent_folding.folding)
+            energy = round(engine.evaluate_structure(seq, structure), 2)
+            results.append(FoldingRecord(structure, energy, approximate=True))
+        return results
+    except KeyboardInterrupt:
+        return None
+
+
+class FoldingBatchTuner:
+
+    # Sequences are folded in batches to reduce the overhead of the task
+    # submission. The batch size is adjusted to make each task take about
+    # `target_task_time` seconds from the measured folding time, but small
+    # enough to give each worker `min_tasks_per_worker` tasks or more.
+    target_task_time = 0.5
+    min_tasks_per_worker = 4
+    smoothing = 0.3
+
+    def __init__(self, n_workers: int):
+        self.n_workers = n_workers
+        self.latency = None
+
+    def update(self, elapsed: float, count: int) -> None:
+        latency = elapsed / count
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.smoothing
+
+    def batch_size(self, n_tasks: int) -> int:
+        if self.latency is None:
+            return 1
+
+        balanced = -(-n_tasks // (self.n_workers * self.min_tasks_per_worker))
+        by_latency = int(self.target_task_time / max(self.latency, 1e-6))
+        return max(1, min(balanced, by_latency))
+
 
 class FoldEvaluator:
 
-    def __init__(self, engine: str):
+    def __init__(self, engine: FoldingEngine, incremental_flank: int=None,
+                 incremental_max_span: float=0.5, window: int=None):
         self.engine = engine
-        self.pat_find_loops = re.compile(r'\.{2,}')
-        self.initialize()
+        self.incremental_flank = incremental_flank
+        self.incremental_max_span = incremental_max_span
+        self.window = window
 
-    def initialize(self):
-        if self.engine == 'vienna':
-            try:
-                import RNA
-            except ImportError:
-                raise ImportError('ViennaRNA module is not available. Try "'
-                                  'pip install ViennaRNA" to install.')
-            self._fold = RNA.fold
-        elif self.engine == 'linearfold':
-            try:
-                import linearfold
-            except ImportError:
-                raise ImportError('LinearFold module is not available. Try "'
-                                  'pip install linearfold-unofficial" to install.')
-            self._fold = linearfold.fold
-        else:
-            raise ValueError(f'Unsupported RNA folding engine: {self.engine}')
+        self.signature = engine.signature
+        if window is not None:
+            self.signature += f',window={window}'
 
     def __call__(self, seq):
-        folding, mfe = self._fold(seq)
-        stems = self.find_stems(folding)
-        folding, stems = self.unfold_unstable_structure(folding, stems)
-        loops = dict(Counter(map(len, self.pat_find_loops.findall(folding))))
-
-        return {
-            'folding': folding,
-            'mfe': mfe,
-            'stems': stems,
-            'loops': loops,
-        }
-
-    @staticmethod
-    def find_stems(structure):
-        stack = []
-        stemgroups = []
-
-        for i, s in enumerate(structure):
-            if s == '(':
-                stack.append(i)
-            elif s == ')':
-                assert len(stack) >= 1
-                peer = stack.pop()
-                if (stemgroups and peer + 1 == stemgroups[-1][0][-1] and
-                        i - 1 == stemgroups[-1][1][-1]):
-                    stemgroups[-1][0].append(peer)
-                    stemgroups[-1][1].append(i)
-                else:
-                    stemgroups.append(([peer], [i]))
+        folding, mfe = self.fold(seq)
+        return self.analyze_structure(folding, mfe)
+
+    def fold(self, seq):
+        if self.window is None or len(seq) <= self.window:
+            return self.engine.fold(seq)
+        return self.fold_windowed(seq)
+
+    def fold_windowed(self, seq):
+        # Folds windows overlapping each other by a half and stitches the
+        # local structures. Each window contributes the pairs centered in
+        # its core, the part closer to its own center than to the centers
+        # of the neighboring windows. Pairs crossing or sharing bases with
+        # the pairs already taken are dropped. The MFE is evaluated for the
+        # stitched structure as a whole.
+        length, window = len(seq), self.window
+        step = window // 2
+        starts = list(range(0, length - window, step)) + [length - window]
+        centers = np.array(starts) + window / 2
+        bounds = np.concatenate([[0], (centers[1:] + centers[:-1]) / 2,
+                                 [length]])
+
+        pairs = np.full(length, -1, dtype=np.int64)
+        for k, start in enumerate(starts):
+            local, _ = self.engine.fold(seq[start:start + window])
+            local_pairs = make_pair_table(local)
+            opened = np.flatnonzero(local_pairs > np.arange(window))
+            centered = (opened + local_pairs[opened]) / 2 + start
+            in_core = (centered >= bounds[k]) & (centered < bounds[k + 1])
+
+            for i, j in zip((opened[in_core] + start).tolist(),
+                            (local_pairs[opened[in_core]] + start).tolist()):
+                if pairs[i] >= 0 or pairs[j] >= 0:
+                    continue
+                enclosed = pairs[i + 1:j]
+                if ((enclosed >= 0) & ((enclosed < i) | (enclosed > j))).any():
+                    continue
+                pairs[i], pairs[j] = j, i
 
-        return stemgroups
+        structure = pair_table_to_structure(pairs)
+        return structure, round(self.engine.evaluate_structure(seq, structure), 2)
 
     @staticmethod
-    def unfold_unstable_structure(folding, stems):
-        # TODO: This needs to be revised based on the thermodynamic model of RNA
-        # folding later.
-        lonepairs = [p for p in stems if len(p[0]) == 1]
-        if not lonepairs:
-            return folding, stems
+    def analyze_structure(folding, mfe, approximate=False):
+        # TODO: Unfolding the lone pairs needs to be revised based on the
+        # thermodynamic model of RNA folding later.
+        analysis = StructureAnalysis.from_structure(folding)
+        analysis = analysis.without_lone_pairs()
+        return FoldingRecord(analysis.structure, mfe, approximate, analysis)
+
+    def fold_incremental(self, seq, parent_seq, parent_folding, validate=False):
+        # Refolds only the regions around the positions that differ from the
+        # parent. Each region is extended by the flanking width and then until
+        # no base pair of the parent structure crosses its boundaries, so that
+        # the refolded regions can be spliced into the parent structure.
+        # The MFE is approximated by adding the local energy changes to the
+        # MFE of the parent.
+        seqarr = np.frombuffer(seq.encode(), dtype=np.uint8)
+        parentarr = np.frombuffer(parent_seq.encode(), dtype=np.uint8)
+        changed = np.flatnonzero(seqarr != parentarr)
+
+        regions = self.find_refolding_regions(changed, parent_folding.folding,
+                                              self.incremental_flank)
+        span = int(sum(end - begin for begin, end in regions))
+
+        if span > len(seq) * self.incremental_max_span:
+            return self(seq), {'mode': 'full', 'span': len(seq)}
+
+        structure = list(parent_folding.folding)
+        mfe = parent_folding.mfe
+        for begin, end in regions:
+            _, mfe_parent = self.fold_parent_region(parent_seq[begin:end])
+            local_child, mfe_child = self.fold(seq[begin:end])
+            structure[begin:end] = local_child
+            mfe += mfe_child - mfe_parent
+
+        approximate = bool(regions) or parent_folding.approximate
+        result = self.analyze_structure(''.join(structure), round(mfe, 2),
+                                        approximate)
+        stats = {'mode': 'local', 'span': span}
+
+        if validate:
+            exact = self(seq)
+            stats['mfe_error'] = result.mfe - exact.mfe
+            stats['bp_distance'] = base_pair_distance(result.folding,
+                                                      exact.folding)
+
+        return result, stats
+
+    def fold_parent_region(self, subseq):
+        key = self.signature, subseq
+        if key in local_fold_cache:
+            local_fold_cache.move_to_end(key)
+            return local_fold_cache[key]
+
+        local_fold_cache[key] = result = self.fold(subseq)
+        while len(local_fold_cache) > LOCAL_FOLD_CACHE_SIZE:
+            local_fold_cache.popitem(last=False)
+        return result
 
-        folding = list(folding)
-        for p5, p3 in lonepairs:
-            folding[p5[0]] = '.'
-            folding[p3[0]] = '.'
-        newstems = [p for p in stems if len(p[0]) > 1]
+    @staticmethod
+    def find_refolding_regions(positions, structure, flank):
+        length = len(structure)
+        pairs = make_pair_table(structure)
+
+        # Group the changed positions into regions of neighboring positions
+        regions = []
+        for pos in positions:
+            begin, end = max(0, pos - flank), min(length, pos + flank + 1)
+            if regions and begin <= regions[-1][1]:
+                regions[-1][1] = end
+            else:
+                regions.append([begin, end])
+
+        # Extend the regions to include all partners of their paired bases
+        closed = []
+        for begin, end in regions:
+            while True:
+                partners = pairs[begin:end]
+                partners = partners[partners >= 0]
+                if len(partners) == 0:
+                    break
+                newbegin = min(begin, partners.min())
+                newend = max(end, partners.max() + 1)
+                if (newbegin, newend) == (begin, end):
+                    break
+                begin, end = newbegin, newend
+
+            closed.append((begin, end))
+
+        # Merge the regions that overlap after the extension
+        merged = []
+        for begin, end in sorted(closed):
+            if merged and begin <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
 
-        return ''.join(folding), newstems
+        return [(int(begin), int(end)) for begin, end in merged]
 
 
 class SequenceEvaluator:
 
-    folding_cache_size = 8192
-
     def __init__(self, scoring_funcs, scoreopts, execopts, mutantgen, species,
                  length_cds, quiet):
         self.scoring_funcs = scoring_funcs
@@ -126,11 +342,47 @@ class SequenceEvaluator:
         self.initialize()
 
     def initialize(self):
-        self.foldeval = FoldEvaluator(self.execopts.folding_engine)
-        self.folding_cache = pylru.lrucache(self.folding_cache_size)
+        self.folding_engines = discover_folding_engines(self.execopts.addons)
+        self.foldeval = FoldEvaluator(
+            self.create_folding_engine(self.execopts.folding_engine),
+            self.execopts.incremental_folding,
+            self.execopts.incremental_folding_max_span,
+            window=self.execopts.folding_window)
+        self.batch_tuner = FoldingBatchTuner(self.execopts.processes)
+
+        # Fast folding engine for screening the sequences before the exact
+        # folding. Its results are kept apart from the exact ones.
+        if self.execopts.screening_engine is not None:
+            self.screening_foldeval = FoldEvaluator(
+                self.create_folding_engine(self.execopts.screening_engine),
+                window=self.execopts.folding_window)
+            self.screening_batch_tuner = FoldingBatchTuner(
+                self.execopts.processes)
+            self.screening_cache = FoldingCache(
+                self.execopts.folding_cache_size * 1048576)
+        else:
+            self.screening_foldeval = None
+        self.folding_cache = FoldingCache(
+            self.execopts.folding_cache_size * 1048576)
+        self.folding_store = self.open_folding_store()
+        self.evaluation_cache = (
+            EvaluationCache(self.execopts.evaluation_cache_size)
+            if self.execopts.evaluation_cache_size > 0 else None)
+        # Largest underestimate of the fitness of the children by the
+        # prefilter seen so far. None until it is measured.
+        self.prefilter_gap = None
+
+        if self.execopts.shared_folding_cache_size > 0:
+            self.shared_cache = SharedFoldingCache.create(
+                self.length_cds,
+                self.execopts.shared_folding_cache_size * 1048576)
+            atexit.register(self.close)
+        else:
+            self.shared_cache = None
 
         self.scorefuncs_nofolding = []
         self.scorefuncs_folding = []
+        self.scorefunc_specs = {}
         self.annotationfuncs = []
         self.penalty_metric_flags = {}
 
@@ -160,6 +412,10 @@ class SequenceEvaluator:
             if funcoff:
                 continue
 
+            # Workers build their own instances once from the same options
+            self.scorefunc_specs[funcname] = (
+                cls, scorefunc_inst.worker_options(dict(opts)))
+
             if cls.uses_folding:
                 self.scorefuncs_folding.append(scorefunc_inst)
             else:
@@ -167,20 +423,220 @@ class SequenceEvaluator:
 
             self.penalty_metric_flags.update(cls.penalty_metric_flags)
 
-    def evaluate(self, seqs, executor):
-        with SequenceEvaluationSession(self, seqs, executor) as sess:
-            sess.evaluate()
+    def open_folding_store(self):
+        size_limit = self.execopts.folding_store_size
+        if size_limit <= 0:
+            return None
 
-            if not sess.errors:
-                total_scores = [sum(s.values()) for s in sess.scores]
-                return total_scores, sess.scores, sess.metrics, sess.foldings
+        try:
+            return FoldingStore(self.foldeval.signature, size_limit * 1048576)
+        except (OSError, sqlite3.Error) as exc:
+            log.warning(f'Folding store is disabled due to an error: {exc}')
+            return None
+
+    def disable_folding_store(self, exc):
+        # The optimization goes on without the store when the database
+        # cannot be used, such as when it is locked by another process.
+        log.warning(f'Folding store is disabled due to an error: {exc}')
+        try:
+            self.folding_store.db.close()
+        except sqlite3.Error:
+            pass
+        self.folding_store = None
+
+    def create_folding_engine(self, name):
+        if name not in self.folding_engines:
+            raise ValueError(f'Unsupported RNA folding engine: {name}')
+        options = self.execopts.folding_engine_options.get(name, {})
+        return self.folding_engines[name](**options)
+
+    def worker_initializer(self) -> dict:
+        shared_cache_args = (
+            self.shared_cache.attach_args()
+            if self.shared_cache is not None else None)
+        engines = [self.foldeval.engine]
+        if self.screening_foldeval is not None:
+            engines.append(self.screening_foldeval.engine)
+
+        return {'initializer': initialize_worker,
+                'initargs': (shared_cache_args, self.scorefunc_specs,
+                             engines)}
+
+    def close(self):
+        if self.shared_cache is not None:
+            self.shared_cache.close(remove=True)
+            self.shared_cache = None
+
+    def lookup_folding(self, seq, screening=False, count=False):
+        if self.shared_cache is not None:
+            folding = self.shared_cache.get(seq, count)
+        else:
+            folding = self.folding_cache.get(seq)
+
+        # Exact foldings are also good for screening.
+        if folding is None and screening:
+            folding = self.screening_cache.get(seq)
+        return folding
+
+    def remember_folding(self, seq, folding, screening=False):
+        # The structures are kept only in the shared cache when it's enabled.
+        if screening:
+            self.screening_cache[seq] = folding
+        elif self.shared_cache is not None:
+            self.shared_cache.put(seq, folding)
+        else:
+            self.folding_cache[seq] = folding
+
+    def evaluate(self, seqs, executor, hints=None, screening=False,
+                 prefilter=None):
+        # Sequences evaluated before, such as the survivors, are taken from
+        # the evaluation cache. The others are evaluated once for each
+        # distinct sequence. Screening results are not cached. A scoring
+        # function that is not per-sequence may depend on the rest of the
+        # population, so the whole population is evaluated as it is then.
+        whole_population = not all(
+            f.per_sequence
+            for f in self.scorefuncs_folding + self.scorefuncs_nofolding)
+        cache = (None if screening or whole_population else
+                 self.evaluation_cache)
+        if cache is not None:
+            cache.validate(self.scoring_signature())
+
+        results = {}
+        query = []
+        for i, seq in enumerate(seqs):
+            if whole_population:
+                query.append(i)
+                continue
+            if seq in results:
+                continue
+            results[seq] = cache.get(seq) if cache is not None else None
+            if results[seq] is None:
+                query.append(i)
+
+        # Parents are in the front of the population with the prefilter.
+        if prefilter is not None:
+            n_parents, n_survivors, margin = prefilter
+            parent_totals = [results[seq][0][0][results[seq][1]]
+                             for seq in set(seqs[:n_parents])
+                             if results[seq] is not None]
+            n_query_parents = sum(i < n_parents for i in query)
+            prefilter = (parent_totals, n_query_parents, n_survivors, margin,
+                         self.prefilter_gap)
+
+        query_seqs = [seqs[i] for i in query]
+        query_hints = [hints[i] for i in query] if hints is not None else None
+        with SequenceEvaluationSession(self, query_seqs, executor, query_hints,
+                                       screening, prefilter) as sess:
+            if query_seqs:
+                sess.evaluate()
+
+        # The statistics are logged after the progress bar is closed.
+        if sess.store_error is not None:
+            self.disable_folding_store(sess.store_error)
+        if self.folding_store is not None and not screening:
+            try:
+                self.folding_store.flush()
+            except sqlite3.Error as exc:
+                self.disable_folding_store(exc)
             else:
-                return None, None, None, None
+                self.folding_store.log_statistics()
+        if self.shared_cache is not None:
+            self.shared_cache.log_statistics()
+
+        if sess.errors:
+            return None, None, None, None
+
+        totals = sum_columns(sess.scores, len(query_seqs))
+        if sess.estimated_totals:
+            self.update_prefilter_gap(totals, sess)
+        if whole_population:
+            log.info(f' # Evaluation: {len(seqs)} sequences evaluated')
+            return totals, sess.scores, sess.metrics, sess.foldings
+
+        log.info(f' # Evaluation: {len(seqs)} sequences -- '
+                 f'{len(seqs) - len(results)} duplicates, '
+                 f'{len(results) - len(query)} cached, '
+                 f'{len(query)} evaluated')
+
+        # The results refer to the rows of the columns of this evaluation.
+        batch = totals, sess.scores, sess.metrics
+        for k, seq in enumerate(query_seqs):
+            results[seq] = batch, k, sess.foldings[k]
+            # Results from the estimated or locally refolded structures are
+            # not kept, so that the sequences are evaluated again in full.
+            if (cache is not None and k not in sess.prefiltered and
+                    not sess.foldings[k].approximate):
+                cache[seq] = results[seq]
+
+        return self.gather_results(seqs, results)
+
+    def gather_results(self, seqs, results):
+        # The scores and the metrics are returned in a column for each name,
+        # gathered from the rows of the evaluations that produced them.
+        groups = {}
+        foldings = []
+        for i, seq in enumerate(seqs):
+            batch, row, folding = results[seq]
+            group = groups.setdefault(id(batch), (batch, [], []))
+            group[1].append(i)
+            group[2].append(row)
+            foldings.append(folding)
+
+        total_scores = np.empty(len(seqs))
+        scores, metrics = {}, {}
+        for (totals, batch_scores, batch_metrics), positions, rows in \
+                groups.values():
+            total_scores[positions] = totals[rows]
+            for columns, batch_columns in ((scores, batch_scores),
+                                           (metrics, batch_metrics)):
+                update_columns(columns, {
+                    name: column[rows]
+                    for name, column in batch_columns.items()},
+                    positions, len(seqs))
+        return total_scores, scores, metrics, foldings
+
+    def update_prefilter_gap(self, totals, sess):
+        # The estimates of the children folded anyway are compared with
+        # their actual fitness.
+        gaps = [totals[k] - estimate
+                for k, estimate in sess.estimated_totals.items()
+                if k not in sess.prefiltered]
+        if gaps:
+            self.prefilter_gap = max(self.prefilter_gap or 0, max(gaps), 0)
+
+    def estimate(self, seqs, executor, hints):
+        # Total scores of the sequences estimated with the structures of
+        # their parents in the hints. Returns None on errors.
+        with SequenceEvaluationSession(self, seqs, executor, hints) as sess:
+            estimated = [sess.lookup_folding(seq) for seq in seqs]
+            if sess.pbar is not None:
+                sess.pbar.total = len(seqs) * len(self.scorefuncs_nofolding)
+                sess.pbar.refresh()
+            ret = sess.estimate_scores(estimated)
+
+        return ret[1] if ret is not None else None
+
+    def scoring_signature(self):
+        # Options of the scoring functions and the folding affecting the
+        # evaluation results
+        options = {
+            name: {k: v for k, v in opts.items() if not k.startswith('_')}
+            for name, opts in self.scoreopts.items()}
+        options['_folding'] = self.foldeval.signature
+        options['_incremental'] = (self.foldeval.incremental_flank,
+                                   self.foldeval.incremental_max_span)
+        return hashlib.sha256(
+            json.dumps(options, sort_keys=True, default=str).encode()).digest()
 
     def get_folding(self, seq):
-        if seq not in self.folding_cache:
-            self.folding_cache[seq] = self.foldeval(seq)
-        return self.folding_cache[seq]
+        # Locally refolded structures are replaced with the exact ones here
+        # as this is used for the reports.
+        folding = self.lookup_folding(seq)
+        if folding is None or folding.approximate:
+            folding = self.foldeval(seq)
+            self.remember_folding(seq, folding)
+        return folding
 
     def prepare_evaluation_data(self, seq):
         folding = self.get_folding(seq)
@@ -206,23 +662,58 @@ class SequenceEvaluator:
 class SequenceEvaluationSession:
 
     def __init__(self, evaluator: SequenceEvaluator, seqs: list[str],
-                 executor: futures.Executor):
+                 executor: futures.Executor, hints: list=None,
+                 screening: bool=False, prefilter: tuple=None):
         self.seqs = seqs
+        self.screening = screening
+        self.prefilter = prefilter if hints is not None else None
+        self.folding_store = None if screening else evaluator.folding_store
+        self.store_error = None
+        self.stored_seqs = set()
+        self.shared_cache = evaluator.shared_cache
         self.executor = executor
+        self.hints = hints
 
-        self.scores = [{} for i in range(len(seqs))]
-        self.metrics = [{} for i in range(len(seqs))]
+        self.scores = {}
+        self.metrics = {}
         self.foldings = [None] * len(seqs)
+        self.nofolding_done = False
+        self.prefiltered = set()
+        self.estimated_totals = {}
+        self.prefilter_summary = None
         self.errors = []
 
-        self.folding_cache = evaluator.folding_cache
+        self.lookup_folding = (
+            lambda seq, count=False: evaluator.lookup_folding(seq, screening,
+                                                              count))
+        self.remember_folding = (
+            lambda seq, folding: evaluator.remember_folding(seq, folding,
+                                                            screening))
         self.foldings_remaining = len(seqs)
-        self.foldeval = evaluator.foldeval
-
-        self.num_tasks = (
+        if screening:
+            self.foldeval = evaluator.screening_foldeval
+            self.batch_tuner = evaluator.screening_batch_tuner
+        else:
+            self.foldeval = evaluator.foldeval
+            self.batch_tuner = evaluator.batch_tuner
+        self.pending_foldings = {}
+        self.use_incremental = (
+            hints is not None and self.foldeval.incremental_flank is not None)
+        self.incremental_check_rate = evaluator.execopts.incremental_folding_check
+        self.use_edits = (
+            hints is not None and evaluator.execopts.incremental_scoring)
+        self.incremental_stats = []
+
+        # Sequences with foldings that are ready but not scored yet
+        self.unscored = []
+        self.population_scorefuncs = []
+        self.scoring_chunk_size = max(
+            1, -(-len(seqs) // self.batch_tuner.n_workers))
+
+        # Progress is counted for each pair of a sequence and a task
+        self.num_tasks = len(seqs) * (
             len(evaluator.scorefuncs_folding) +
-            len(evaluator.scorefuncs_nofolding) +
-            len(seqs))
+            len(evaluator.scorefuncs_nofolding) + 1)
 
         self.pbar = None
         self.quiet = evaluator.quiet
@@ -230,74 +721,359 @@ class SequenceEvaluationSession:
         self.scorefuncs_folding = evaluator.scorefuncs_folding
         self.scorefuncs_nofolding = evaluator.scorefuncs_nofolding
         self.annotationfuncs = evaluator.annotationfuncs
+        self.codon2aa = evaluator.mutantgen.codon2aa
+        self.features = None
     
     def __enter__(self):
+        # Features of the sequences are prepared once for the scoring
+        # functions using them.
+        if (self.seqs and len(set(map(len, self.seqs))) == 1 and
+                (self.use_edits or
+                 any(f.uses_features for f in
+                     self.scorefuncs_folding + self.scorefuncs_nofolding))):
+            self.features = SequenceFeatures.create(self.seqs, self.codon2aa)
+
         log.info('')
         self.pbar = tqdm(total=self.num_tasks, disable=self.quiet,
-                         file=sys.stderr, unit='task', desc='Scoring fitness')
+                         file=sys.stderr, unit='task',
+                         desc='Screening' if self.screening else 'Scoring fitness')
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.features is not None:
+            self.features.remove()
+
         if self.pbar is not None:
             self.pbar.close()
         log.info('')
 
+        if self.prefilter_summary is not None:
+            log.info(self.prefilter_summary)
+        if self.incremental_stats:
+            self.log_incremental_stats()
+
     def evaluate(self) -> None:
         jobs = set()
 
+        if self.folding_store is not None:
+            self.load_stored_foldings()
+
+        if self.prefilter is not None:
+            self.run_prefilter()
+
         # Secondary structure prediction is the first set of tasks.
+        # The lookups deciding whether to fold are counted in the cache
+        # statistics once for each sequence, except for the foldings just
+        # loaded from the store.
+        tasks = []
+        counted = set(self.stored_seqs)
         for i, seq in enumerate(self.seqs):
-            if self.errors: # skip remaining tasks on error
+            if self.foldings[i] is not None: # skipped by the prefilter
                 continue
 
-            if seq in self.folding_cache:
-                self.foldings[i] = self.folding_cache[seq]
+            # Approximate foldings are reused only for incremental refolding.
+            folding = self.lookup_folding(seq, count=seq not in counted)
+            counted.add(seq)
+            if folding is not None and folding.approximate and not (
+                    self.use_incremental and self.hints[i] is not None):
+                folding = None
+            if folding is not None:
+                self.foldings[i] = folding
                 self.foldings_remaining -= 1
+                self.unscored.append(i)
                 if self.pbar is not None:
                     self.pbar.update()
                 continue
+            elif seq in self.pending_foldings: # duplicated in the population
+                self.pending_foldings[seq].append(i)
+                continue
 
-            future = self.executor.submit(self.foldeval, seq)
-            future._seqidx = i
+            self.pending_foldings[seq] = [i]
+            hint = self.hints[i] if self.use_incremental else None
+            # Validation against full refolding is done for a fixed
+            # fraction of sequences chosen by their checksums.
+            validate = hint is not None and (
+                zlib.crc32(seq.encode()) / 0xffffffff <
+                self.incremental_check_rate)
+            tasks.append((seq, hint, validate))
+
+        # Children of the same parent are put together to share the local
+        # folds of the parent regions in the workers.
+        if self.use_incremental:
+            tasks.sort(key=lambda task: task[1][0] if task[1] is not None
+                       else '')
+
+        batch_size = self.batch_tuner.batch_size(len(tasks))
+        log.debug(f'Folding {len(tasks)} sequences in batches of {batch_size}')
+        for begin in range(0, len(tasks), batch_size):
+            if self.errors: # skip remaining tasks on error
+                break
+
+            batch = tasks[begin:begin + batch_size]
+            future = self.executor.submit(fold_batch, self.foldeval, batch,
+                                          not self.screening)
+            future._seqs = [seq for seq, _, _ in batch]
             future._type = 'folding'
             jobs.add(future)
 
         # Then, scoring functions that does not require folding are executed.
+        if not self.errors and not self.nofolding_done:
+            jobs |= self.submit_nofolding_scoring()
+
+        # Scoring functions requiring folding are executed as the foldings
+        # arrive. Those that are not per-sequence wait for all foldings.
+        self.population_scorefuncs = [
+            scorefunc for scorefunc in self.scorefuncs_folding
+            if not scorefunc.per_sequence]
+        jobs |= self.submit_ready_scoring()
+        self.wait_for_jobs(jobs)
+
+    def submit_nofolding_scoring(self):
+        jobs = set()
+        all_indices = list(range(len(self.seqs)))
+        edited = (self.find_edits() if self.use_edits and
+                  self.features is not None else None)
         for scorefunc in self.scorefuncs_nofolding:
-            if self.errors:
+            indices = all_indices
+            if edited is not None and scorefunc.supports_edits:
+                indices = self.score_edits(scorefunc, *edited)
+            if indices:
+                jobs |= self.submit_sharded_scoring(scorefunc, indices)
+        self.nofolding_done = True
+        return jobs
+
+    def find_edits(self):
+        # The codon changes of all children from their parents are found at
+        # once. Returns the indices of the children, those of the other
+        # sequences and the edits.
+        children, remaining, parents = [], [], {}
+        for i, seq in enumerate(self.seqs):
+            if self.hints[i] is None or len(self.hints[i][0]) != len(seq):
+                remaining.append(i)
                 continue
+            children.append(i)
+            parents.setdefault(self.hints[i][0], len(parents))
+
+        if not children:
+            return None
+
+        parent_rows = np.array([parents[self.hints[i][0]] for i in children])
+        edits = CodonEdits(self.features.codons[children],
+                           encode_population(list(parents)), parent_rows)
+        return children, remaining, edits
+
+    def score_edits(self, scorefunc, children, remaining, edits):
+        # The children are scored in the main process from the contributions
+        # of their parents, for all children at once. Returns the indices of
+        # the other sequences to be scored in full.
+        contribs = scorefunc.prepare_edits(edits.parent_codons)
+        scores, metrics = scorefunc.score_edits(contribs, edits)
+        update_columns(self.scores, scores, children, len(self.seqs))
+        update_columns(self.metrics, metrics, children, len(self.seqs))
+        if self.pbar is not None:
+            self.pbar.update(len(children))
+        return remaining
 
-            future = self.executor.submit(scorefunc, self.seqs)
-            future._type = 'scoring'
-            jobs.add(future)
-
-        # Wait until all folding tasks are finished.
-        while jobs and not self.errors and self.foldings_remaining > 0:
-            done, jobs = futures.wait(jobs, timeout=0.1,
+    def submit_ready_scoring(self):
+        # The sequences with foldings are scored in chunks to keep the
+        # number of tasks small. The rest are scored after the last folding.
+        jobs = set()
+        if self.errors:
+            return jobs
+
+        if self.unscored and (len(self.unscored) >= self.scoring_chunk_size or
+                              self.foldings_remaining == 0):
+            indices, self.unscored = sorted(self.unscored), []
+            for scorefunc in self.scorefuncs_folding:
+                if scorefunc.per_sequence:
+                    jobs |= self.submit_sharded_scoring(scorefunc, indices,
+                                                        self.foldings)
+
+        if self.foldings_remaining == 0 and self.population_scorefuncs:
+            all_indices = list(range(len(self.seqs)))
+            for scorefunc in self.population_scorefuncs:
+                jobs.add(self.submit_scoring(scorefunc, all_indices,
+                                             self.foldings))
+            self.population_scorefuncs = []
+
+        return jobs
+
+    def submit_sharded_scoring(self, scorefunc, indices, foldings=None,
+                               scores=None, metrics=None):
+        # Per-sequence scoring functions are run in parallel for chunks of
+        # the sequences.
+        if not scorefunc.per_sequence:
+            return {self.submit_scoring(scorefunc, indices, foldings, scores,
+                                        metrics)}
+
+        size = self.scoring_chunk_size
+        return set(
+            self.submit_scoring(scorefunc, indices[begin:begin + size],
+                                foldings, scores, metrics)
+            for begin in range(0, len(indices), size))
+
+    def submit_scoring(self, scorefunc, indices, foldings=None,
+                       scores=None, metrics=None):
+        if len(indices) == len(self.seqs):
+            args = [self.seqs] if foldings is None else [self.seqs, foldings]
+        else:
+            args = [[self.seqs[i] for i in indices]]
+            if foldings is not None:
+                args.append([foldings[i] for i in indices])
+
+        kwargs = {}
+        if scorefunc.uses_features:
+            kwargs['features'] = (
+                self.features.subset(indices)
+                if self.features is not None and
+                   len(indices) < len(self.seqs) else self.features)
+
+        future = self.executor.submit(run_scoring, scorefunc.name, *args,
+                                      **kwargs)
+        future._type = 'scoring'
+        future._indices = indices
+        future._scores = self.scores if scores is None else scores
+        future._metrics = self.metrics if metrics is None else metrics
+        return future
+
+    def wait_for_jobs(self, jobs):
+        while jobs and not self.errors:
+            done, jobs = futures.wait(jobs,
                                       return_when=futures.FIRST_COMPLETED)
             for future in done:
                 if future._type == 'folding':
                     self.collect_folding(future)
                 elif future._type == 'scoring':
                     self.collect_scores(future)
+                elif future._type == 'estimation':
+                    self.collect_estimation(future)
+
+            jobs |= self.submit_ready_scoring()
+
+    def run_prefilter(self):
+        # Folding of the children is skipped when their fitness estimated
+        # with the structures of their parents falls below that of the
+        # survivors among the parents by more than the margin. The estimate
+        # is not a bound of the fitness, so the margin is widened by the
+        # largest underestimate seen in the earlier iterations, and nothing
+        # is skipped until it is measured. The estimated scores are kept for
+        # the skipped children.
+        # Only the per-sequence scoring functions can score the subsets.
+        # The first n_parents sequences are the parents to be evaluated in
+        # this session, and parent_totals are the scores of the others.
+        parent_totals, n_parents, n_survivors, margin, gap = self.prefilter
+        estimated = [self.lookup_folding(seq) for seq in self.seqs]
+        if (len(parent_totals) + n_parents < n_survivors or
+                None in estimated[:n_parents] or
+                not all(f.per_sequence for f in self.scorefuncs_folding)):
+            return
+
+        ret = self.estimate_scores(estimated)
+        if ret is None:
+            return
+        rows, est_totals, est_scores, est_metrics = ret
+
+        cutoff = sorted(list(est_totals[:n_parents]) + list(parent_totals),
+                        reverse=True)[n_survivors - 1]
+
+        children = [i for i in rows
+                    if estimated[i].approximate and i >= n_parents]
+        self.estimated_totals = {i: est_totals[i] for i in children}
+        skipped = [] if gap is None else [
+            i for i in children if est_totals[i] < cutoff - margin - gap]
+        self.prefiltered = set(skipped)
+        for i in skipped:
+            self.foldings[i] = estimated[i]
+        self.foldings_remaining -= len(skipped)
+        for columns, est_columns in ((self.scores, est_scores),
+                                     (self.metrics, est_metrics)):
+            update_columns(columns, {
+                name: column[skipped]
+                for name, column in est_columns.items()},
+                skipped, len(self.seqs))
+        if self.pbar is not None:
+            self.pbar.update(len(skipped) * (1 + len(self.scorefuncs_folding)))
+
+        self.prefilter_summary = (
+            f' # Prefilter: skipped folding of {len(skipped)} of '
+            f'{len(self.seqs) - n_parents} sequences' +
+            (f' (margin {margin + gap:.3f})' if gap is not None else
+             ' (measuring the estimation errors)'))
+
+    def estimate_scores(self, estimated):
+        # The sequences without foldings in `estimated` are given the
+        # structures of their parents evaluated on them. Returns the indices
+        # of the sequences with the structures, the estimated total scores,
+        # and the scores and the metrics from the scoring functions with
+        # folding. Returns None on errors.
+        self.estimated_foldings = estimated
+        jobs = self.submit_nofolding_scoring()
+
+        tasks = [(i, seq, self.hints[i][1])
+                 for i, seq in enumerate(self.seqs)
+                 if estimated[i] is None and self.hints[i] is not None]
+
+        batch_size = max(1, -(-len(tasks) // self.batch_tuner.n_workers))
+        for begin in range(0, len(tasks), batch_size):
+            batch = tasks[begin:begin + batch_size]
+            future = self.executor.submit(
+                estimate_batch, self.foldeval.engine,
+                [(seq, folding) for _, seq, folding in batch])
+            future._type = 'estimation'
+            future._indices = [i for i, _, _ in batch]
+            jobs.add(future)
+
+        self.wait_for_jobs(jobs)
+        if self.errors:
+            return None
 
-        # Scoring functions requiring folding are executed.
+        rows = [i for i, folding in enumerate(estimated) if folding is not None]
+        if self.pbar is not None:
+            self.pbar.total += len(rows) * len(self.scorefuncs_folding)
+            self.pbar.refresh()
+
+        est_scores, est_metrics = {}, {}
+        jobs = set()
         for scorefunc in self.scorefuncs_folding:
-            if self.errors:
-                continue
+            jobs |= self.submit_sharded_scoring(scorefunc, rows, estimated,
+                                                est_scores, est_metrics)
+        self.wait_for_jobs(jobs)
+        if self.errors:
+            return None
 
-            future = self.executor.submit(scorefunc, self.seqs,
-                                          self.foldings)
-            future._type = 'scoring'
-            jobs.add(future)
+        est_totals = (sum_columns(self.scores, len(self.seqs)) +
+                      sum_columns(est_scores, len(self.seqs)))
+        return rows, est_totals, est_scores, est_metrics
 
-        while jobs and not self.errors:
-            done, jobs = futures.wait(jobs, timeout=0.1)
-            for future in done:
-                if future._type == 'folding':
-                    self.collect_folding(future)
-                elif future._type == 'scoring':
-                    self.collect_scores(future)
+    def collect_estimation(self, future):
+        try:
+            ret = future.result()
+            if ret is None:
+                self.errors.append('KeyboardInterrupt')
+                return
+        except Exception as exc:
+            return self.handle_exception(exc)
+
+        for i, folding in zip(future._indices, ret):
+            self.estimated_foldings[i] = folding
+
+    def load_stored_foldings(self):
+        missing = [seq for seq in set(self.seqs)
+                   if self.lookup_folding(seq) is None]
+        if not missing:
+            return
+
+        # Errors are reported by the evaluator after the session.
+        try:
+            stored = self.folding_store.lookup(missing)
+        except sqlite3.Error as exc:
+            self.store_error = exc
+            self.folding_store = None
+            return
+
+        for seq, (structure, mfe) in stored.items():
+            self.remember_folding(seq, FoldingRecord(structure, mfe))
+        self.stored_seqs = set(stored)
 
     def collect_scores(self, future):
         try:
@@ -313,38 +1089,48 @@ class SequenceEvaluationSession:
             return self.handle_exception(exc)
 
         if self.pbar is not None:
-            self.pbar.update()
+            self.pbar.update(len(future._indices))
 
-        # Update scores
-        for k, updates in scoreupdates.items():
-            assert len(updates) == len(self.scores)
-            for s, u in zip(self.scores, updates):
-                s[k] = u
+        for updates in scoreupdates.values():
+            assert len(updates) == len(future._indices)
+        for updates in metricupdates.values():
+            assert len(updates) == len(future._indices)
 
-        # Update metrics
-        for k, updates in metricupdates.items():
-            assert len(updates) == len(self.metrics)
-            for s, u in zip(self.metrics, updates):
-                s[k] = u
+        update_columns(future._scores, scoreupdates, future._indices,
+                       len(self.seqs))
+        update_columns(future._metrics, metricupdates, future._indices,
+                       len(self.seqs))
 
     def collect_folding(self, future):
         try:
-            folding = future.result()
-            if folding is None:
+            ret = future.result()
+            if ret is None:
                 self.errors.append('KeyboardInterrupt')
                 if self.pbar is not None:
                     self.pbar.close()
                 self.pbar = None
                 return
+            results, elapsed = ret
         except Exception as exc:
             return self.handle_exception(exc)
-        i = future._seqidx
-        self.foldings[i] = folding
-        self.folding_cache[self.seqs[i]] = folding
-        self.foldings_remaining -= 1
 
-        if self.pbar is not None:
-            self.pbar.update()
+        self.batch_tuner.update(elapsed, len(results))
+
+        for seq, (folding, stats) in zip(future._seqs, results):
+            if stats is not None:
+                self.incremental_stats.append(stats)
+
+            indices = self.pending_foldings.pop(seq)
+            for i in indices:
+                self.foldings[i] = folding
+            self.unscored.extend(indices)
+            self.remember_folding(seq, folding)
+            if self.folding_store is not None and not folding.approximate:
+                self.folding_store.add(seq, folding.folding, folding.mfe)
+            self.foldings_remaining -= len(indices)
+
+            if self.pbar is not None:
+                self.pbar.update(len(indices))
 
     def handle_exception(self, exc):
         import traceback
@@ -364,3 +1150,21 @@ class SequenceEvaluationSession:
 
         log.error('\n'.join(msg))
         self.errors.append(exc.args)
+
+    def log_incremental_stats(self):
+        stats = self.incremental_stats
+        local = [st['span'] for st in stats if st['mode'] == 'local']
+        msg = (f' # Incremental folding: {len(local)} local '
+               f'(mean span {np.mean(local) if local else 0:.0f} nt), '
+               f'{len(stats) - len(local)} full')
+
+        checked = [st for st in stats if 'mfe_error' in st]
+        if checked:
+            mfe_errors = np.abs([st['mfe_error'] for st in checked])
+            bp_distances = [st['bp_distance'] for st in checked]
+            msg += (f' -- validated {len(checked)}: '
+                    f'mean |dMFE| {np.mean(mfe_errors):.2f}, '
+                    f'max |dMFE| {np.max(mfe_errors):.2f}, '
+                    f'mean bp distance {np.mean(bp_distances):.1f}')
+
+        log.info(msg)
@@ -0,0 +1,377 @@
+#
+# VaxPress
+#
+# Copyright 2023 Seoul National University
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# “Software”), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR
+# THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from collections import Counter
+from functools import cached_property
+import numpy as np
+import re
+
+# Secondary structures are stored with two bits per base in this order
+STRUCTURE_SYMBOLS = b'.()'
+SYMBOL_CODES = np.zeros(256, dtype=np.uint8)
+SYMBOL_CODES[list(STRUCTURE_SYMBOLS)] = np.arange(len(STRUCTURE_SYMBOLS))
+CODE_SYMBOLS = np.frombuffer(STRUCTURE_SYMBOLS + b'.', dtype=np.uint8)
+
+CANONICAL_PAIR_CODES = [ord(p[0]) * 256 + ord(p[1])
+                        for p in ['AU', 'UA', 'GC', 'CG', 'GU', 'UG']]
+
+pat_find_loops = re.compile(r'\.{2,}')
+
+# Loop types in the bpRNA notation used by DegScore: stem, multiloop,
+# internal loop, bulge, hairpin loop, dangling end and external loop
+LOOP_TYPES = 'SMIBHEX'
+LOOP_STEM, LOOP_MULTI, LOOP_INTERNAL, LOOP_BULGE, LOOP_HAIRPIN, \
+    LOOP_DANGLING, LOOP_EXTERNAL = range(len(LOOP_TYPES))
+
+
+def pack_structure(structure: str) -> np.ndarray:
+    codes = SYMBOL_CODES[np.frombuffer(structure.encode(), dtype=np.uint8)]
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) |
+            (quads[:, 3] << 6)).astype(np.uint8)
+
+def unpack_structure(packed: np.ndarray, length: int) -> str:
+    codes = np.empty((len(packed), 4), dtype=np.uint8)
+    for i in range(4):
+        codes[:, i] = (packed >> (i * 2)) & 3
+    return CODE_SYMBOLS[codes.ravel()[:length]].tobytes().decode()
+
+def make_pair_table(structure):
+    # Brackets on the same nesting level alternate between opening and
+    # closing ones, so sorting the brackets by level and then by position
+    # places each opening bracket right before its partner.
+    symbols = np.frombuffer(structure.encode(), dtype=np.uint8)
+    opening = symbols == ord('(')
+    closing = symbols == ord(')')
+    depth = np.cumsum(opening.astype(np.int32) - closing)
+    brackets = np.flatnonzero(opening | closing)
+    levels = depth[brackets] + closing[brackets]
+    ordered = brackets[np.lexsort((brackets, levels))]
+
+    pairs = np.full(len(symbols), -1, dtype=np.int64)
+    pairs[ordered[0::2]] = ordered[1::2]
+    pairs[ordered[1::2]] = ordered[0::2]
+    return pairs
+
+def assign_loop_types(pairs):
+    length = len(pairs)
+    index = np.arange(length)
+    types = np.full(length, LOOP_STEM, dtype=np.uint8)
+    opening = pairs > index
+    closing = (pairs >= 0) & (pairs < index)
+    unpaired = np.flatnonzero(pairs < 0)
+    if len(unpaired) == 0:
+        return types
+
+    openers = np.flatnonzero(opening)
+    if len(openers) == 0:
+        types[:] = LOOP_DANGLING
+        return types
+
+    # The loop containing an unpaired base or the outer pair of a helix is
+    # closed by the last opening bracket before it at the enclosing level.
+    depth = np.cumsum(opening.astype(np.int64) - closing)
+    members = np.flatnonzero(~closing)
+    levels = depth[members] - opening[members]
+    scale = length + 1
+    keys = np.sort(depth[openers] * scale + openers)
+    found = np.searchsorted(keys, levels * scale + members) - 1
+    closers = np.where((found >= 0) & (levels > 0),
+                       keys[np.maximum(found, 0)] % scale, -1)
+    enclosing = np.full(length, -1, dtype=np.int64)
+    enclosing[members] = closers
+
+    inner = openers[enclosing[openers] >= 0]
+    branches = np.bincount(enclosing[inner], minlength=length)
+    branch = np.full(length, -1, dtype=np.int64)
+    branch[enclosing[inner]] = inner
+
+    outside = unpaired[enclosing[unpaired] < 0]
+    last_closing = pairs[openers].max()
+    types[outside] = np.where(
+        (outside < openers[0]) | (outside > last_closing),
+        LOOP_DANGLING, LOOP_EXTERNAL)
+
+    inside = unpaired[enclosing[unpaired] >= 0]
+    closer = enclosing[inside]
+    nbranches = branches[closer]
+    left = inside < branch[closer]
+    single = nbranches == 1
+    has_left = np.bincount(closer[single & left], minlength=length) > 0
+    has_right = np.bincount(closer[single & ~left], minlength=length) > 0
+    types[inside] = np.select(
+        [nbranches == 0, nbranches > 1, has_left[closer] & has_right[closer]],
+        [LOOP_HAIRPIN, LOOP_MULTI, LOOP_INTERNAL], LOOP_BULGE)
+    return types
+
+def pair_table_to_structure(pairs):
+    index = np.arange(len(pairs))
+    symbols = np.full(len(pairs), ord('.'), dtype=np.uint8)
+    symbols[pairs > index] = ord('(')
+    symbols[(pairs >= 0) & (pairs < index)] = ord(')')
+    return symbols.tobytes().decode()
+
+def remove_noncanonical_pairs(seq, structure):
+    pairs = make_pair_table(structure)
+    opened = np.flatnonzero(pairs > np.arange(len(pairs)))
+    bases = np.frombuffer(seq.encode(), dtype=np.uint8)
+    pair_codes = bases[opened].astype(np.uint32) * 256 + bases[pairs[opened]]
+    invalid = opened[~np.isin(pair_codes, CANONICAL_PAIR_CODES)]
+    if len(invalid) == 0:
+        return structure
+
+    symbols = np.frombuffer(structure.encode(), dtype=np.uint8).copy()
+    symbols[invalid] = symbols[pairs[invalid]] = ord('.')
+    return symbols.tobytes().decode()
+
+def base_pair_distance(structure1, structure2):
+    pairs1 = make_pair_table(structure1)
+    pairs2 = make_pair_table(structure2)
+    index = np.arange(len(pairs1))
+    opened1, opened2 = pairs1 > index, pairs2 > index
+    shared = opened1 & opened2 & (pairs1 == pairs2)
+    return int(opened1.sum() + opened2.sum() - 2 * shared.sum())
+
+# The pure Python versions of the structure analysis below are kept as the
+# reference implementations of StructureAnalysis.
+def find_stems(structure):
+    stack = []
+    stemgroups = []
+
+    for i, s in enumerate(structure):
+        if s == '(':
+            stack.append(i)
+        elif s == ')':
+            assert len(stack) >= 1
+            peer = stack.pop()
+            if (stemgroups and peer + 1 == stemgroups[-1][0][-1] and
+                    i - 1 == stemgroups[-1][1][-1]):
+                stemgroups[-1][0].append(peer)
+                stemgroups[-1][1].append(i)
+            else:
+                stemgroups.append(([peer], [i]))
+
+    return stemgroups
+
+def unfold_unstable_structure(folding, stems):
+    # TODO: This needs to be revised based on the thermodynamic model of RNA
+    # folding later.
+    lonepairs = [p for p in stems if len(p[0]) == 1]
+    if not lonepairs:
+        return folding, stems
+
+    folding = list(folding)
+    for p5, p3 in lonepairs:
+        folding[p5[0]] = '.'
+        folding[p3[0]] = '.'
+    newstems = [p for p in stems if len(p[0]) > 1]
+
+    return ''.join(folding), newstems
+
+def find_loops(structure):
+    return dict(Counter(map(len, pat_find_loops.findall(structure))))
+
+
+
+class StructureAnalysis:
+
+    # Features derived from the pair table of a secondary structure. All
+    # the scoring functions and the mutant generator share an instance of
+    # this per folding, so the structure is parsed only once.
+
+    def __init__(self, pairs: np.ndarray):
+        self.pairs = pairs
+
+    @classmethod
+    def from_structure(cls, structure: str):
+        return cls(make_pair_table(structure))
+
+    @cached_property
+    def structure(self) -> str:
+        return pair_table_to_structure(self.pairs)
+
+    @cached_property
+    def paired(self) -> np.ndarray:
+        return self.pairs >= 0
+
+    @cached_property
+    def stem_bounds(self) -> tuple:
+        # Consecutive closing brackets form a stem when their partners are
+        # also consecutive. Stems are ordered by their innermost closing
+        # bracket as in find_stems.
+        closes = np.flatnonzero(self.pairs >= 0)
+        closes = closes[self.pairs[closes] < closes]
+        partners = self.pairs[closes]
+        continued = ((closes[1:] - 1 == closes[:-1]) &
+                     (partners[1:] + 1 == partners[:-1]))
+        starts = np.flatnonzero(np.concatenate([[True], ~continued]))
+        if len(closes) == 0:
+            starts = starts[:0]
+        ends = np.append(starts[1:], len(closes))
+        return closes, partners, starts, ends
+
+    @cached_property
+    def stem_lengths(self) -> np.ndarray:
+        _, _, starts, ends = self.stem_bounds
+        return ends - starts
+
+    @cached_property
+    def stems(self) -> list:
+        closes, partners, starts, ends = self.stem_bounds
+        closes, partners = closes.tolist(), partners.tolist()
+        return [(partners[b:e], closes[b:e])
+                for b, e in zip(starts.tolist(), ends.tolist())]
+
+    @cached_property
+    def lone_pairs(self) -> np.ndarray:
+        closes, _, starts, _ = self.stem_bounds
+        return closes[starts[self.stem_lengths == 1]]
+
+    @cached_property
+    def loop_runs(self) -> tuple:
+        # Start positions and lengths of the runs of unpaired bases
+        edges = np.diff(np.concatenate([[0], (~self.paired).view(np.int8),
+                                        [0]]))
+        starts = np.flatnonzero(edges == 1)
+        return starts, np.flatnonzero(edges == -1) - starts
+
+    @cached_property
+    def loops(self) -> dict:
+        lengths = self.loop_runs[1]
+        lengths, counts = np.unique(lengths[lengths >= 2], return_counts=True)
+        return dict(zip(lengths.tolist(), counts.tolist()))
+
+    @cached_property
+    def loop_types(self) -> np.ndarray:
+        # Indices into LOOP_TYPES for every base
+        return assign_loop_types(self.pairs)
+
+    @cached_property
+    def unpaired_codons(self) -> np.ndarray:
+        unpaired = np.zeros((len(self.pairs) + 2) // 3 * 3, dtype=bool)
+        unpaired[:len(self.pairs)] = ~self.paired
+        return np.flatnonzero(unpaired.reshape(-1, 3).any(axis=1))
+
+    def total_loop_length(self, threshold: int) -> int:
+        lengths = self.loop_runs[1]
+        return int(lengths[lengths >= threshold].sum())
+
+    def count_paired(self, begin: int, end: int) -> int:
+        return int(self.paired[begin:end].sum())
+
+    def without_lone_pairs(self):
+        lonepairs = self.lone_pairs
+        if len(lonepairs) == 0:
+            return self
+
+        pairs = self.pairs.copy()
+        pairs[pairs[lonepairs]] = -1
+        pairs[lonepairs] = -1
+        return StructureAnalysis(pairs)
+
+
+class FoldingRecord:
+
+    # Only the packed structure and the MFE are kept. The other fields are
+    # derived from the structure analysis, which is built on the first
+    # access and never pickled nor counted in the cache size, to keep the
+    # cached and transferred records small. The record can be accessed like
+    # the dict used in the earlier versions, e.g., folding['stems'], for the
+    # compatibility with addons.
+    __slots__ = ('packed', 'length', 'mfe', 'approximate', '_analysis')
+
+    fields = ('folding', 'mfe', 'stems', 'loops')
+
+    # Approximate memory footprint of the record object itself and its array
+    object_overhead = 200
+
+    def __init__(self, structure: str, mfe: float, approximate: bool=False,
+                 analysis: StructureAnalysis=None):
+        self.packed = pack_structure(structure)
+        self.length = len(structure)
+        self.mfe = mfe
+        self.approximate = approximate
+        self._analysis = analysis
+
+    @classmethod
+    def from_packed(cls, packed: np.ndarray, length: int, mfe: float,
+                    approximate: bool=False):
+        record = cls.__new__(cls)
+        record.packed = packed
+        record.length = length
+        record.mfe = mfe
+        record.approximate = approximate
+        record._analysis = None
+        return record
+
+    def __getstate__(self):
+        return (self.packed, self.length, self.mfe, self.approximate)
+
+    def __setstate__(self, state):
+        self.packed, self.length, self.mfe, self.approximate = state
+        self._analysis = None
+
+    @property
+    def analysis(self) -> StructureAnalysis:
+        if self._analysis is None:
+            self._analysis = StructureAnalysis.from_structure(self.folding)
+        return self._analysis
+
+    def copy(self):
+        # Shallow copy sharing the packed structure but not the analysis
+        return self.from_packed(self.packed, self.length, self.mfe,
+                                self.approximate)
+
+    @property
+    def folding(self) -> str:
+        return unpack_structure(self.packed, self.length)
+
+    @property
+    def stems(self) -> list:
+        return self.analysis.stems
+
+    @property
+    def loops(self) -> dict:
+        return self.analysis.loops
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes + self.object_overhead
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return self[key] if key in self.fields else default
+
+    def keys(self):
+        return iter(self.fields)